@@ -1,6 +1,11 @@
 
 
 import os
+import signal
+import curses
+from fcntl import ioctl
+from termios import TIOCGWINSZ
+from struct import pack, unpack
 
 from libmd import *
 import sys
@@ -11,7 +16,6 @@ import sys
 import locale
 locale.setlocale(locale.LC_ALL, '')
 
-from socket import gethostbyname, error as se
 from libmd.md import *
 
 def addNotice(s):
@@ -51,17 +55,22 @@ class MDGUI(SocketMultiplexer):
         mainwin.setTitle("Deadline v0.1")
         mainwin.setTitleAlignment(TITLE_MODE_CENTERED)
         gui.show()
+        self.addSignalHandler(signal.SIGWINCH, self.onResize)
         addNotice("Welcome to MDGUI v0.1")
         addNotice("You can type '/quit' to quit," +
             " or type something else to simply see it" +
             " show up in this window :-)")
         self.startMultiplex()
 
-    def onSignal(self):
+    def onResize(self, signum):
         """
-            Handles SIGWINCH for terminal resizing.
+            Handles SIGWINCH for terminal resizing. Our handler replaces the
+            one of curses, so the new size is passed on to curses here.
         """
-        gui.stdscr.touchwin()
+        height, width = unpack('hh',
+            ioctl(sys.stdout.fileno(), TIOCGWINSZ, pack('hh', 0, 0)))
+        curses.resizeterm(height, width)
+        gui.resizeEvent()
         while gui.inputEvent():
             pass
 
@@ -81,25 +90,29 @@ class MDGUI(SocketMultiplexer):
             return
 
         s = server.split(' ')
+
+        # A local server is reached through its unix domain socket
+        if len(s) == 1 and s[0].startswith('/'):
+            self.connecting = True
+            self.connect(s[0], None, sock=ClientSocket)
+            addOutgoing('Connecting to %s' % repr(server))
+            return
+
         if len(s) != 2:
-            addNotice('Invalid format. Correct format: <host> <port>')
+            addNotice('Invalid format. Correct format: <host> <port> or ' +
+                '</path/to/socket>')
             return False
 
         host, port = s
-        try:
-            ip = gethostbyname(host)
-        except se, e:
-            addNotice('Could not resolve:' + host)
-            return False
-
         try:
             port = int(port)
         except ValueError:
             addNotice('Could not turn port into an int...')
             return False
 
+        # The host is resolved in the background, the GUI keeps running
         self.connecting = True
-        self.connect(ip, port, sock=ClientSocket)
+        self.connect(host, port, sock=ClientSocket)
         addOutgoing('Connecting to %s' % repr(server))
 
     def onNoExecute(self, str):
@@ -148,6 +161,14 @@ class ClientSocket(ManagedMDSocket):
     def registerFail(self, reason):
         pass
 
+    def onQuit(self, reason):
+        addNotice('Server quit: ' + reason)
+        self.close()
+
+    def onResolveFail(self):
+        self.muxer.connecting = False
+        addNotice('Could not resolve:' + self._ip)
+
 
 gui = DeadGUI()
 app = MDGUI()
@@ -0,0 +1,416 @@
+# aio.py - asyncio transport bridge
+"""
+    The asyncio transport bridge
+
+    This library runs protocols written against ManagedSocket, such as
+    ManagedMDSocket subclasses, on an asyncio event loop instead of the
+    SocketMultiplexer loop. The protocol classes are combined with
+    TransportSocketMixin, which routes their I/O through an asyncio
+    transport, and they are handed an AsyncioMultiplexer in place of their
+    SocketMultiplexer.
+
+    On Python 2 this needs the trollius port of asyncio, which is no longer
+    maintained and is not a dependency of libmd itself. The tested version
+    is pinned in tests/requirements.txt. Without it this module cannot be
+    imported.
+
+    Only a subset of the SocketMultiplexer interface is provided: connect,
+    listen, broadcast, scheduleRead, callSoon, callSoonThreadsafe, setAlarm
+    and the event queue 'eq'. There is no runInThread, runInProcess,
+    resolver, scheduleFlush or addSignalHandler, use the asyncio loop for
+    those instead; connect resolves host names through the loop. On the
+    sockets SEND_COALESCE, READ_BUDGET and ACCEPT_BUDGET have no effect,
+    the transport decides how data is written and read.
+
+    Attributes an application adds to its multiplexer have to be added to
+    its AsyncioMultiplexer subclass as well. For the MD server these come
+    with server.MDServerMixin, so MDSocket runs unmodified on an
+    AsyncioMultiplexer that inherits it, see tests/test_aio.py.
+"""
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+import socket
+from mulsoc import SocketMultiplexer, ManagedSocket, BroadcastMixin, \
+    peerCredentials
+
+class AsyncioEventQueue(object):
+    """
+        Event queue with the DeadEventQueue interface that schedules events
+        on an asyncio loop. Time is kept by the loop, so elapseTime and
+        nextEventTicks have nothing to do.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def scheduleEvent(self, event):
+        """
+            Schedule an event for execution.
+        """
+        if event._handle is not None:
+            self.cancelEvent(event)
+        event._handle = self.loop.call_later(event.getDelay(),
+            self._trigger, event)
+        return event._handle
+
+    def cancelEvent(self, ev):
+        """
+            Cancel a scheduled event.
+        """
+        if ev._handle is not None:
+            ev._handle.cancel()
+            ev._handle = None
+
+    def _trigger(self, event):
+        event._handle = None
+        event.delay = 0.0
+        event.trigger(self)
+
+    def elapseTime(self, time):
+        pass
+
+    def nextEventTicks(self):
+        return None
+
+class TransportSocketMixin(object):
+    """
+        Mixin for ManagedSocket classes that replaces their non-blocking
+        socket I/O by an asyncio transport. The first constructor argument
+        is the transport, if any, the others are passed on unchanged.
+    """
+
+    def __init__(self, transport, *args, **keywords):
+        self._transport = transport
+        super(TransportSocketMixin, self).__init__(*args, **keywords)
+
+    def setTransport(self, transport):
+        """
+            Start using 'transport', applying the send queue watermarks.
+        """
+        self._transport = transport
+        if self.SEND_HIGH_WATER is not None:
+            transport.set_write_buffer_limits(self.SEND_HIGH_WATER,
+                self.SEND_LOW_WATER)
+
+    def connectionMade(self, transport):
+        """
+            Take over an outgoing connection established by asyncio.
+        """
+        if self._sock is not None:
+            self._sock.close()
+        self.setTransport(transport)
+        self._sock = transport.get_extra_info('socket')
+        if self._family != socket.AF_UNIX:
+            self._ip, self._port = transport.get_extra_info('sockname')[:2]
+            self._peer_ip, self._peer_port = \
+                transport.get_extra_info('peername')[:2]
+        self._state = ManagedSocket.CONNECTED
+        self.onConnect()
+
+    def connectionFailed(self):
+        """
+            Called when an outgoing connection could not be established.
+        """
+        self._state = ManagedSocket.DISCONNECTED
+        self.onConnectionRefuse()
+
+    def connectionLost(self):
+        if self._wpaused:
+            self._resumeSend()
+        if self._state == ManagedSocket.CONNECTED:
+            self._state = ManagedSocket.DISCONNECTED
+            self.onDisconnect()
+
+    def handleRead(self):
+        """
+            Continue the work held back by yieldRead(), new data is
+            delivered by the transport.
+        """
+        if not self._ryield or self._state != ManagedSocket.CONNECTED:
+            return False
+        self._beginRead()
+        self._ryield = False
+        self.onReadResume()
+        if self._ryield:
+            self.muxer.scheduleRead(self)
+        elif not self._rpaused and self._state == ManagedSocket.CONNECTED:
+            self._transport.resume_reading()
+        return True
+
+    def handleWrite(self):
+        return False
+
+    def send(self, data):
+        """
+            Hand data to the transport for sending.
+        """
+        if self._state != ManagedSocket.CONNECTED:
+            return False
+        self._transport.write(data)
+        return True
+
+    def close(self):
+        """
+            Close the transport.
+        """
+        if self._state == ManagedSocket.CLOSED:
+            return False
+        if self._wpaused:
+            self._resumeSend()
+        if self._transport is not None:
+            self._transport.close()
+        elif self._sock is not None:
+            self._sock.close()
+        self._sock = None
+        self._state = ManagedSocket.CLOSED
+        return True
+
+    def pauseReading(self):
+        if self._rpaused:
+            return False
+        self._rpaused = True
+        if self._transport is not None:
+            self._transport.pause_reading()
+        return True
+
+    def resumeReading(self):
+        if not self._rpaused:
+            return False
+        self._rpaused = False
+        if self._transport is not None:
+            self._transport.resume_reading()
+        return True
+
+    def bytesInSendQueue(self):
+        if self._transport is None:
+            return 0
+        return self._transport.get_write_buffer_size()
+
+_bridged = {}
+
+def bridge(sock):
+    """
+        Returns the class combining ManagedSocket class 'sock' with
+        TransportSocketMixin.
+    """
+    try:
+        return _bridged[sock]
+    except KeyError:
+        new = type(sock.__name__, (TransportSocketMixin, sock), {})
+        _bridged[sock] = new
+        return new
+
+class ManagedProtocol(asyncio.Protocol):
+    """
+        asyncio Protocol driving a bridged ManagedSocket.
+
+        For accepted connections the managed socket is created once the
+        connection is made, and handed to the listener's onAccept().
+    """
+
+    def __init__(self, muxer, managed = None, sock = None, listener = None):
+        self.muxer = muxer
+        self.managed = managed
+        self.sock = sock
+        self.listener = listener
+
+    def connection_made(self, transport):
+        if self.managed is not None:
+            self.managed.connectionMade(transport)
+            return
+
+        sock = transport.get_extra_info('socket')
+        if sock.family == socket.AF_UNIX:
+            if not self.listener.checkPeerCredentials(*peerCredentials(sock)):
+                transport.close()
+                return
+            addr = (self.listener._ip, None)
+        else:
+            addr = transport.get_extra_info('peername')[:2]
+
+        self.managed = bridge(self.sock)(None, self.muxer, (sock,), addr)
+        self.managed.setTransport(transport)
+        if self.listener is not None:
+            self.listener.onAccept(self.managed)
+
+    def data_received(self, data):
+        managed = self.managed
+        if managed is not None and managed.isConnected():
+            managed._beginRead()
+            managed._ryield = False
+            managed.onRecv(memoryview(data))
+
+            # Hold back the transport until the socket resumes
+            if managed._ryield and managed.isConnected():
+                self.muxer.scheduleRead(managed)
+                managed._transport.pause_reading()
+
+    # The transport applies the watermarks, the managed socket only keeps
+    # track of the state and its stall timeout.
+    def pause_writing(self):
+        if self.managed.isConnected():
+            self.managed._pauseSend()
+            self.managed.onPause()
+
+    def resume_writing(self):
+        if self.managed.isSendPaused():
+            self.managed._resumeSend()
+            self.managed.onDrain()
+
+    def eof_received(self):
+        if self.managed is not None:
+            self.managed.connectionLost()
+
+    def connection_lost(self, exc):
+        if self.managed is not None:
+            self.managed.connectionLost()
+
+class AsyncioMultiplexer(BroadcastMixin):
+    """
+        Stand-in for SocketMultiplexer that runs managed sockets on an
+        asyncio event loop. Inherit to create an application, like you would
+        inherit SocketMultiplexer.
+    """
+
+    def __init__(self, sock = None, loop = None):
+        if sock is None:
+            sock = ManagedSocket
+        self._sock = sock
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.eq = AsyncioEventQueue(loop)
+        self._alarm = None
+        self._servers = []
+
+    def startMultiplex(self):
+        """
+            Run the asyncio loop until stopMultiplex is called.
+        """
+        self.loop.run_forever()
+        return True
+
+    def stopMultiplex(self):
+        """
+            Stop multiplexing.
+        """
+        if not self.loop.is_running():
+            return False
+        self.loop.stop()
+        return True
+
+    def connect(self, ip, port, **keywords):
+        """
+            Initiate a client connection to the specified server.
+
+            Like SocketMultiplexer.connect, 'sock = <some class>' overrides
+            the socket instantiator and other keywords are passed on to the
+            socket constructor.
+        """
+        sock = keywords.pop('sock', self._sock)
+        new = bridge(sock)(None, self, ip, port, **keywords)
+        new._state = ManagedSocket.CONNECTING
+        new._peer_ip, new._listening_port = ip, port
+
+        if port is None:
+            f = self.loop.create_unix_connection(
+                lambda: ManagedProtocol(self, managed = new), ip)
+        else:
+            f = self.loop.create_connection(
+                lambda: ManagedProtocol(self, managed = new), ip, port)
+        f = asyncio.ensure_future(f, loop = self.loop)
+        f.add_done_callback(lambda f: self._connectDone(f, new))
+        return True
+
+    def _connectDone(self, f, new):
+        if not f.cancelled() and f.exception() is not None:
+            new.connectionFailed()
+
+    def listen(self, ip, port,
+            queue_length = None, reuse_port = False, **keywords):
+        """
+            Create a new socket that will start listening on the specified
+            address. The listening socket is created by the 'sock' class as
+            usual, accepted connections are served through asyncio.
+        """
+        if queue_length == None:
+            queue_length = SocketMultiplexer.LISTEN_QUEUE_DEFAULT
+        sock = keywords.pop('sock', self._sock)
+        new = sock(self, ip, port, **keywords)
+        if not new.listen(queue_length, reuse_port):
+            return False
+
+        f = asyncio.ensure_future(self.loop.create_server(
+            lambda: ManagedProtocol(self, sock = self._sock, listener = new),
+            sock = new._sock, backlog = queue_length), loop = self.loop)
+        f.add_done_callback(self._listenDone)
+        return True
+
+    def _listenDone(self, f):
+        if not f.cancelled() and f.exception() is None:
+            self._servers.append(f.result())
+
+    def flush(self):
+        """
+            Transports write right away, there is nothing to flush.
+        """
+
+    def scheduleRead(self, sock):
+        """
+            Call the handleRead() method of 'sock' on the next loop pass.
+        """
+        self.loop.call_soon(sock.handleRead)
+
+    # Readiness of bridged sockets is handled by their transports
+    def addReader(self, sock):
+        return True
+
+    def delReader(self, sock):
+        return True
+
+    def addWriter(self, sock):
+        return True
+
+    def delWriter(self, sock):
+        return True
+
+    def callSoon(self, call, *args, **kargs):
+        """
+            Queue 'call' for execution on the loop thread.
+        """
+        self.loop.call_soon(lambda: call(*args, **kargs))
+
+    def callSoonThreadsafe(self, call, *args, **kargs):
+        """
+            Queue 'call' for execution on the loop thread, from any thread.
+        """
+        self.loop.call_soon_threadsafe(lambda: call(*args, **kargs))
+
+    def setAlarm(self, seconds):
+        """
+            Sets an alarm that will occur in 'seconds' time, seconds may be
+            fractional. If seconds is None any pending alarm will be cancelled
+        """
+
+        if self._alarm is not None:
+            self._alarm.cancel()
+            self._alarm = None
+        if seconds is not None:
+            self._alarm = self.loop.call_later(seconds, self.execAlarm)
+        return True
+
+    def execAlarm(self):
+        """
+            Handler that executes the onAlarm() method.
+        """
+        self._alarm = None
+        self.onAlarm()
+
+    def onAlarm(self):
+        """
+            Called when the alarm set by setAlarm() occurs
+        """
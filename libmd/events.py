@@ -8,6 +8,32 @@
 """
 
 from heapq import heappush, heappop, heapify
+from itertools import count
+
+# Monotonic clock used for driving the event queues, so that the events
+# system is not affected by changes of the wall clock.
+try:
+    from time import monotonic
+except ImportError:
+    try:
+        import ctypes, ctypes.util
+
+        class _timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        # CLOCK_MONOTONIC from <linux/time.h>
+        _CLOCK_MONOTONIC = 1
+        _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt'),
+            use_errno = True).clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+        def monotonic():
+            t = _timespec()
+            if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(t)):
+                raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+            return t.tv_sec + t.tv_nsec * 1e-9
+    except (ImportError, OSError, AttributeError):
+        from time import time as monotonic
 
 class DeadEvent(object):
     """
@@ -15,11 +41,16 @@ class DeadEvent(object):
         events
     """
 
+    __slots__ = ('delay', 'odelay', '_handle')
+
     def __init__(self, delay):
         delay = float(delay)
         self.delay = delay
         self.odelay = delay
 
+        # Queue specific bookkeeping of a scheduled event
+        self._handle = None
+
     def trigger(self, eq):
         """
 Method called when event occurs.
@@ -67,6 +98,8 @@ class DeferredCall(DeadEvent):
         a given period of time.
     """
 
+    __slots__ = ('call', 'args', 'kargs')
+
     def __init__(self, delay, call, *args, **kargs):
         DeadEvent.__init__(self, delay)
         self.call = call
@@ -82,94 +115,279 @@ class PeriodicCall(DeferredCall):
         frequency as long as the call keeps returning True.
     """
 
+    __slots__ = ()
+
     def trigger(self, eq):
         if self.call(*self.args, **self.kargs):
             self.delay = self.odelay
             eq.scheduleEvent(self)
 
 class DeadEventQueue(object):
+    """
+        Heap based event queue.
+
+        The queue keeps its own clock, which is advanced by elapseTime. Events
+        are stored as [deadline, sequence, event] entries ordered by their
+        absolute deadline, so elapsing time only touches events that expire.
+        Cancelled entries are left in the heap as tombstones and skipped when
+        they surface, both scheduling and cancelling are O(log n).
+    """
+
+    # Events due within this margin are triggered right away
+    TOLERANCE = 0.001
+
     def __init__(self):
         self.events = []
-        self.isheap = True
+        self.now = 0.0
+        self.seq = count()
+        self.cancelled = 0
         self.elapsing = False
 
     def scheduleEvent(self, event):
         """
             Schedule an event for execution.
+
+            Returns the handle of the scheduled event, which is also kept by
+            the event itself for cancelEvent.
         """
 
+        if event._handle is not None:
+            self.cancelEvent(event)
+
+        entry = [self.now + event.getDelay(), next(self.seq), event]
+        event._handle = entry
+
         # Since it is possible for events to be scheduled
-        # during the execution of elapseTime (which would ruin our queue)
+        # during the execution of elapseTime
         # (Events can re-schedule themselves upon triggering)
-        # we defer those calls until the elapse call is complete
+        # we defer those inserts until the elapse call is complete,
+        # so an event never triggers twice in one call.
         if self.elapsing:
-            self.scheds.append(event)
-            return
-
-        # Guarantee heap structure
-        if not self.isheap:
-            heapify(self.events)
-            self.isheap = True
-
-        heappush(self.events, event)
+            self.scheds.append(entry)
+        else:
+            heappush(self.events, entry)
+        return entry
 
     def cancelEvent(self, ev):
         """
             Cancel a scheduled event.
 
-            Cancelling is an expensive operation since it breaks the heap
-            structure, it is therefore recommended to group inserts together
-            and keep them separate from cancels which should also be grouped.
-            This way the penalty for cancellation is minimized.
+            The heap entry of the event is turned into a tombstone, the heap
+            is only rebuilt when tombstones make up most of it.
         """
 
-        # Same goes for events being cancelled
-        if self.elapsing:
-            self.cancels.append(ev)
-        else:
-            if ev in self.events:
-                self.events.remove(ev)
-                self.isheap = len(self.events) == 0
+        entry = ev._handle
+        if entry is None:
+            return
+        entry[2] = None
+        ev._handle = None
+        self.cancelled += 1
+
+        if self.cancelled > 64 and self.cancelled > len(self.events) >> 1 \
+                and not self.elapsing:
+            self.events = [e for e in self.events if e[2] is not None]
+            heapify(self.events)
+            self.cancelled = 0
 
     def elapseTime(self, time):
         """
             "Atomically" elapse the time of events in the queue
         """
 
-        self.scheds = []
-        self.cancels = []
-
-        # Guarantee heap structure
-        if not self.isheap:
-            heapify(self.events)
-            self.isheap = True
+        self.now += time
+        events = self.events
+        if not events or events[0][0] > self.now + self.TOLERANCE:
+            return
 
-        # Do elapse
+        self.scheds = []
         self.elapsing = True
-        while len(self.events) and self.events[0].elapseTime(time, self):
-            heappop(self.events)
-        for ev in self.events[1:]: ev.elapseTime(time, self)
-        self.elapsing = False
- 
-        # Insert events scheduled in the mean time
-        for ev in self.scheds: self.scheduleEvent(ev)
-        for ev in self.cancels: self.cancelEvent(ev)
-
-        del self.cancels
-        del self.scheds
+        try:
+            while events and events[0][0] <= self.now + self.TOLERANCE:
+                ev = heappop(events)[2]
+                if ev is None:
+                    self.cancelled -= 1
+                    continue
+                ev._handle = None
+                ev.delay = 0.0
+                ev.trigger(self)
+        finally:
+            self.elapsing = False
+
+            # Insert events scheduled in the mean time
+            for entry in self.scheds:
+                if entry[2] is not None:
+                    heappush(events, entry)
+                else:
+                    self.cancelled -= 1
+            del self.scheds
 
     def nextEventTicks(self):
         """
             Returns the ticks remaining till the next event.
         """
 
-        # Guarantee heap structure
-        if not self.isheap:
-            heapify(self.events)
-            self.isheap = True
+        events = self.events
+        while events and events[0][2] is None:
+            heappop(events)
+            self.cancelled -= 1
 
-        if len(self.events):
-            return self.events[0].getDelay()
+        if events:
+            return max(0.0, events[0][0] - self.now)
 
         return None
 
+class TimingWheelQueue(object):
+    """
+        Hierarchical timing wheel implementation of the event queue.
+
+        Time is divided in ticks of 'resolution' seconds. Events expiring
+        within 'slots' ticks are kept in the slots of the first wheel, events
+        further away are kept in the coarser wheels and moved down (cascaded)
+        once their slot comes up. Scheduling, cancelling and expiring an
+        event are O(1), at the cost of rounding delays up to a whole tick.
+
+        This queue offers the same interface as DeadEventQueue, and is meant
+        for large amounts of timers such as per-connection timeouts.
+    """
+
+    def __init__(self, resolution = 0.01, slots = 256, levels = 4):
+        self.resolution = float(resolution)
+        self.bits = slots.bit_length() - 1
+        self.mask = (1 << self.bits) - 1
+        if slots != 1 << self.bits:
+            raise ValueError('slots must be a power of two')
+        self.wheels = [[{} for i in xrange(slots)] for l in xrange(levels)]
+
+        # Events further away than the wheels reach are parked in the last
+        # slot they can reach and re-placed upon cascading.
+        self.horizon = (1 << (self.bits * levels)) - 1
+
+        # Current tick, and the time elapsed since that tick
+        self.tick = 0
+        self.remainder = 0.0
+
+        self.count = 0
+        self._next = None
+
+    def _place(self, ev, expires):
+        """
+            Put 'ev' in the slot matching its absolute expiry tick.
+        """
+        diff = min(expires - self.tick, self.horizon)
+        at = self.tick + diff
+        level = 0
+        while diff > self.mask:
+            diff >>= self.bits
+            level += 1
+        slot = self.wheels[level][(at >> (self.bits * level)) & self.mask]
+        slot[id(ev)] = ev
+        ev._handle = (slot, expires)
+
+    def scheduleEvent(self, event):
+        """
+            Schedule an event for execution.
+        """
+        if event._handle is not None:
+            self.cancelEvent(event)
+
+        # Round up to whole ticks, an event never expires in the current one
+        ticks = (self.remainder + event.getDelay()) / self.resolution
+        expires = self.tick + max(1, int(ticks) + (ticks > int(ticks)))
+        self._place(event, expires)
+        self.count += 1
+        self._next = None
+
+    def cancelEvent(self, ev):
+        """
+            Cancel a scheduled event.
+        """
+        handle = ev._handle
+        if handle is None:
+            return
+        del handle[0][id(ev)]
+        ev._handle = None
+        self.count -= 1
+        self._next = None
+
+    def _cascade(self, level):
+        """
+            Redistribute the current slot of wheel 'level' over the lower
+            wheels.
+        """
+        index = (self.tick >> (self.bits * level)) & self.mask
+        if index == 0 and level + 1 < len(self.wheels):
+            self._cascade(level + 1)
+        slot = self.wheels[level][index]
+        if slot:
+            self.wheels[level][index] = {}
+            for ev in slot.itervalues():
+                self._place(ev, ev._handle[1])
+
+    def elapseTime(self, time):
+        """
+            Elapse time, triggering every event that expires.
+        """
+
+        self.remainder += time
+        ticks = int(self.remainder / self.resolution)
+        if not ticks:
+            return
+        self.remainder -= ticks * self.resolution
+        self._next = None
+
+        wheel = self.wheels[0]
+        while ticks:
+            # Nothing to do when there are no events at all
+            if not self.count:
+                self.tick += ticks
+                break
+
+            self.tick += 1
+            ticks -= 1
+            index = self.tick & self.mask
+            if index == 0 and len(self.wheels) > 1:
+                self._cascade(1)
+
+            slot = wheel[index]
+            if slot:
+                # Events may schedule and cancel events while triggering
+                wheel[index] = {}
+                while slot:
+                    ev = slot.popitem()[1]
+                    ev._handle = None
+                    self.count -= 1
+                    ev.delay = 0.0
+                    ev.trigger(self)
+
+    def nextEventTicks(self):
+        """
+            Returns the time remaining till the next event, or till the next
+            cascade that could bring an event closer.
+        """
+
+        if not self.count:
+            return None
+        if self._next is not None:
+            return self._next
+
+        best = None
+        for level, wheel in enumerate(self.wheels):
+            shift = self.bits * level
+
+            # Slots of coarser wheels are only cascaded on their boundaries,
+            # which are never earlier than the best candidate found so far.
+            boundary = ((self.tick >> shift) + 1) << shift
+            if best is not None and best <= boundary:
+                break
+
+            current = self.tick >> shift
+            for k in xrange(1, self.mask + 2):
+                if wheel[(current + k) & self.mask]:
+                    at = (current + k) << shift
+                    if best is None or at < best:
+                        best = at
+                    break
+
+        self._next = max(0.0,
+            (best - self.tick) * self.resolution - self.remainder)
+        return self._next
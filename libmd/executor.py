@@ -0,0 +1,174 @@
+# executor.py - Blocking work offloading
+"""
+    Blocking work offloading
+
+    This file implements thread and process pools that execute blocking calls
+    on behalf of a SocketMultiplexer. Every call returns a LoopFuture that is
+    completed on the multiplexer thread, so its callbacks may safely use
+    sockets and the event queue.
+"""
+
+import threading
+from Queue import Queue
+from multiprocessing import cpu_count
+
+class LoopFuture(object):
+    """
+        The result of a call executed outside of the multiplexer thread.
+    """
+
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """
+            Returns the result of the call, or raises the exception it raised.
+        """
+        if not self._done:
+            raise RuntimeError('Result is not available yet')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        """
+            Returns the exception raised by the call, or None.
+        """
+        if not self._done:
+            raise RuntimeError('Result is not available yet')
+        return self._exception
+
+    def addDoneCallback(self, call):
+        """
+            Call 'call' with this future as argument once it is done.
+        """
+        if self._done:
+            call(self)
+        else:
+            self._callbacks.append(call)
+
+    def setResult(self, result):
+        self._result = result
+        self._complete()
+
+    def setException(self, exception):
+        self._exception = exception
+        self._complete()
+
+    def _complete(self):
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for call in callbacks:
+            call(self)
+
+class ThreadExecutor(object):
+    """
+        Pool of daemon threads executing calls for a multiplexer. The threads
+        are started on first use.
+    """
+
+    def __init__(self, muxer, workers = 4):
+        self.muxer = muxer
+        self.workers = workers
+        self._queue = Queue()
+        self._threads = []
+
+    def submit(self, call, *args, **kargs):
+        """
+            Execute 'call' on a pool thread, returns a LoopFuture.
+        """
+        if not self._threads:
+            for i in range(self.workers):
+                t = threading.Thread(target = self._work,
+                    name = 'ThreadExecutor-%i' % i)
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+
+        future = LoopFuture()
+        self.muxer._outstanding += 1
+        self._queue.put((future, call, args, kargs))
+        return future
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            future, call, args, kargs = job
+            result = exception = None
+
+            # Whatever the call raises, the future has to be completed
+            try:
+                result = call(*args, **kargs)
+            except BaseException, e:
+                exception = e
+            self.muxer.callSoonThreadsafe(self._done, future, result,
+                exception)
+
+    def _done(self, future, result, exception):
+        try:
+            if exception is not None:
+                future.setException(exception)
+            else:
+                future.setResult(result)
+        finally:
+            self.muxer._outstanding -= 1
+
+    def shutdown(self, wait = False):
+        """
+            Stop the pool threads once they finish their current work. With
+            'wait' this returns once they have stopped.
+        """
+        for t in self._threads:
+            self._queue.put(None)
+        if wait:
+            for t in self._threads:
+                t.join()
+        self._threads = []
+
+class ProcessExecutor(ThreadExecutor):
+    """
+        Pool of processes executing calls for a multiplexer, for CPU bound
+        work. Calls, arguments and results need to be picklable. The pool is
+        started on first use.
+
+        Every pool process is fed by a thread that waits for its result, so
+        errors in the pool itself, such as a call that cannot be pickled,
+        complete the future like any other exception. Multiprocessing on
+        Python 2 offers no error callback for apply_async.
+    """
+
+    def __init__(self, muxer, workers = None):
+        if workers is None:
+            workers = cpu_count()
+        ThreadExecutor.__init__(self, muxer, workers)
+        self._pool = None
+
+    def submit(self, call, *args, **kargs):
+        """
+            Execute 'call' in a pool process, returns a LoopFuture.
+        """
+        if self._pool is None:
+            from multiprocessing import Pool
+            self._pool = Pool(self.workers)
+        return ThreadExecutor.submit(self, self._pool.apply, call, args,
+            kargs)
+
+    def shutdown(self, wait = False):
+        """
+            Stop the pool processes once they finish their current work.
+            With 'wait' this returns once they have stopped.
+        """
+        ThreadExecutor.shutdown(self, wait)
+        if self._pool is not None:
+            self._pool.close()
+            if wait:
+                self._pool.join()
+            self._pool = None
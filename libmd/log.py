@@ -2,8 +2,9 @@
 
 from time import localtime
 import gzip
-from os import listdir
+from os import listdir, rename, remove, path
 from time import time
+from shutil import copyfileobj
 
 # Logger class.
 class PyLogger(object):
@@ -33,6 +34,9 @@ class PyLogger(object):
         # File descriptors and their data.
         self._fds = {}
 
+        # Runs slow calls like compressing rotated logs, see set_executor()
+        self._executor = None
+
     def __del__(self):
         """
             We should probably free files here.
@@ -79,6 +83,16 @@ class PyLogger(object):
         """
         return self._fds.iterkeys()
 
+    def set_executor(self, executor):
+        """
+            Set the function used to run slow calls, such as compressing a
+            rotated log, off the calling thread. It is called as
+            executor(call, *args) and returns a future with
+            addDoneCallback() and exception(), SocketMultiplexer.runInThread
+            fits. If no executor is set, these calls are made inline.
+        """
+        self._executor = executor
+
     def set_log_fmt(self, logfmt):
         """
             Set the format for the log.
@@ -117,26 +131,56 @@ class PyLogger(object):
     def _rotateFile(self, f, i):
         fn = f.name[:f.name.rfind('/')+1]
         ft = f.name[f.name.rfind('/')+1:]
-        dl = sorted(filter(lambda x: x.startswith(ft + '.gz.'),
-                listdir(fn)))
+        # Sort numerically, the reserved name of a rotation that is still
+        # being compressed must never be picked again. Neither must the
+        # number of a log that was kept uncompressed, see _compressFailed.
+        dl = sorted(map(lambda x: int(x[x.rfind('.')+1:]),
+                filter(lambda x: x[:x.rfind('.')] in (ft, ft + '.gz') and
+                    x[x.rfind('.')+1:].isdigit(), listdir(fn))))
         if len(dl) == 0:
             rfn = fn + ft + '.gz.0'
         else:
-            lf = dl[-1:][0]
-            ln = int(lf[lf.rfind('.')+1:]) + 1
+            ln = dl[-1] + 1
             rfn = fn + ft + '.gz.%s' % str(ln)
 
-        f.seek(0)
-        f_out = gzip.open(rfn, 'w')
-        f_out.writelines(f)
-        f_out.close()
-
+        # Move the full log out of the way, so a new one can be started
+        # right away while the old one is compressed.
         del self._fds[f]
         f.close()
+        tmp = fn + '.' + ft + '.rotating.' + rfn[rfn.rfind('.')+1:]
+        rename(fn + ft, tmp)
+
+        # Reserve the name, so the next rotation does not pick it as well
+        open(rfn, 'w').close()
+
         f = open(fn + ft, 'w+')
         self.assign_logfile(f, i['level'], i['outputs'])
         self[f]['rotate'] = i['rotate']
 
+        if self._executor is None:
+            try:
+                _compress_file(tmp, rfn)
+            except Exception, e:
+                self._compressFailed(tmp, rfn, e)
+        else:
+            self._executor(_compress_file, tmp, rfn).addDoneCallback(
+                lambda future: self._compressDone(future, tmp, rfn))
+
+    def _compressDone(self, future, tmp, rfn):
+        if future.exception() is not None:
+            self._compressFailed(tmp, rfn, future.exception())
+
+    def _compressFailed(self, tmp, rfn, error):
+        # Give up the reserved name, and keep the rotated log uncompressed
+        # under a visible name instead.
+        kfn = rfn[:rfn.rfind('.gz.')] + rfn[rfn.rfind('.'):]
+        if path.exists(tmp):
+            if path.exists(rfn):
+                remove(rfn)
+            rename(tmp, kfn)
+        self.log([], 0, PyLogger.ERROR, 'Compressing rotated log', kfn,
+            'failed:', error)
+
     def _internal_write(self, f, i, txt, vlus):
         f.write(txt + '\n')
         if vlus:
@@ -154,6 +198,17 @@ class PyLogger(object):
                 t.tm_min, t.tm_sec)
 
 
+def _compress_file(src, dst):
+    """
+        Compress file 'src' into gzip file 'dst', and remove 'src'.
+    """
+    f_in = open(src, 'rb')
+    f_out = gzip.open(dst, 'wb')
+    copyfileobj(f_in, f_out)
+    f_out.close()
+    f_in.close()
+    remove(src)
+
 class FileAlreadyExistsException(Exception):
     """
         Thrown when the file already exists in the FD dict.
@@ -2,7 +2,7 @@
     MD = Mufasa Daemon
 """
 
-from struct import pack, unpack
+from struct import pack, unpack_from
 from mulsoc import ManagedSocket
 
 MD_REG_CLIENT           = 100 # Register request
@@ -15,6 +15,21 @@ MD_PONG                 = 140 # Pong reply
 
 MD_QUIT                 = 150 # Quit request / notification
 
+MD_HEADER_SIZE          = 4   # Length and type, both uint16_t
+MD_MAX_MESSAGE          = 196 # Maximum message length, header excluded
+
+# Allowed message lengths (header excluded) per message type, checked as soon
+# as a header arrives. Types not listed here are bound by md_default_limit.
+md_message_limits = {
+    MD_REG_CLIENT       : (1, MD_MAX_MESSAGE),
+    MD_REGISTER_OK      : (0, 0),
+    MD_REGISTER_FAIL    : (0, MD_MAX_MESSAGE),
+    MD_PING             : (0, MD_MAX_MESSAGE),
+    MD_PONG             : (0, MD_MAX_MESSAGE),
+    MD_QUIT             : (0, MD_MAX_MESSAGE)
+}
+md_default_limit = (0, MD_MAX_MESSAGE)
+
 class MDPackException(Exception):
     """
         This exception is thrown if the message passed to dcpPackMessage
@@ -31,11 +46,11 @@ def mdPackMessage(type, message = ''):
     """
         Returns a packed MD message, ready for sending through a socket.
     """
-    if len(message) > 196:
+    if len(message) > MD_MAX_MESSAGE:
         raise MDPackException("Message exceeds 196 characters.")
     if mdValidateMessage(message) != MDV_NO_VIOLATION:
         raise MDPackException("Message contains non-printable characters.")
-    header = pack('!HH', len(message) + 4, type)
+    header = pack('!HH', len(message) + MD_HEADER_SIZE, type)
     return header + message
 
 def mdPackWords(*words):
@@ -49,9 +64,17 @@ def mdPackWords(*words):
     return packstr + words[-1]
 
 def mdValidateMessage(message):
-    for i in message:
-        if i not in md_charset:
-            return MDV_INVALID_MESSAGE
+    """
+        Validates the characters of a message, which may be a string or a
+        buffer such as a memoryview.
+
+        Every valid character is deleted with a single translate() call, any
+        character that remains is not part of md_charset.
+    """
+    if type(message) is not str:
+        message = memoryview(message).tobytes()
+    if message.translate(None, md_charset):
+        return MDV_INVALID_MESSAGE
 
     return MDV_NO_VIOLATION
 
@@ -59,15 +82,21 @@ def mdValidateMessageHeader(_type, length):
     """
         Validates the message header of a message that has not yet been
         completely received.
+
+        'length' is the length field of the header, which includes the
+        header itself.
     """
-    # FIXME: Implement
+    minimum, maximum = md_message_limits.get(_type, md_default_limit)
+    if not minimum <= length - MD_HEADER_SIZE <= maximum:
+        return MDV_INVALID_LENGTH
     return MDV_NO_VIOLATION
 
 # List of protocol violations
 MDV_NO_VIOLATION, \
 MDV_MANUAL_VIOLATION, \
 MDV_UNIMPLEMENTED, \
-MDV_INVALID_MESSAGE = range(4)
+MDV_INVALID_MESSAGE, \
+MDV_INVALID_LENGTH = range(5)
 
 # Build debug dictionary for converting numbers to their
 # equivalent DCPV_*** string name
@@ -83,7 +112,8 @@ mdv2strerr = {
     MDV_NO_VIOLATION : "No violation",
     MDV_MANUAL_VIOLATION : " Manual Violation",
     MDV_UNIMPLEMENTED : "Unimplemented",
-    MDV_INVALID_MESSAGE : "Invalid message"
+    MDV_INVALID_MESSAGE : "Invalid message",
+    MDV_INVALID_LENGTH : "Invalid message length"
 }
 
 # Build accepted character set
@@ -95,69 +125,116 @@ hexdigits = hexdigits[:16]
 
 class ManagedMDSocket(ManagedSocket):
 
+    # Decoded messages are only discarded from the stream buffer once the
+    # read cursor has passed this many bytes, or when the buffer is drained.
+    STREAM_COMPACT_SIZE = 65536
+
+    # Maximum amount of messages dispatched per multiplexer iteration, None
+    # for no limit. Once reached the socket yields to the others, and the
+    # remaining messages are dispatched in the next multiplexer iteration.
+    FRAME_BUDGET = None
+
     def __init__(self, *argv):
         ManagedSocket.__init__(self, *argv)
         
         self.recv_activity = False
 
-        self.stream = ''
+        # Received data, decoded up to 'streampos'
+        self.stream = bytearray()
+        self.streampos = 0
 
-        self.curtype = None
-        self.curlen = None
+        # Messages left to dispatch in this multiplexer iteration
+        self._fbudget = self.FRAME_BUDGET
 
         self.handlers = {
                 MD_REG_CLIENT   : (self.handleSendMessage, self.onRegClient),
                 MD_REGISTER_OK  : (self.handleRawArg, self.onRegisterOk),
                 MD_REGISTER_FAIL: (self.handleRawArg, self.onRegisterFail),
                 MD_PING         : (self.handleRawArg, self.onPing),
-                MD_PONG         : (self.handleRawArg, self.onPong)
+                MD_PONG         : (self.handleRawArg, self.onPong),
+                MD_QUIT         : (self.handleRawArg, self.onQuit)
         }
 
     def onRecv(self, data):
         self.recv_activity = True
         self.stream += data
-        while self.isConnected() and self.handleStream():
-            pass
+        self.handleStream()
 
     def handleStream(self):
         """
             This function does the actual stream processing.
+
+            All complete messages in the stream are decoded in a single pass
+            by moving a cursor over the buffer. Every message is copied out
+            of the stream once, that string is validated and passed to the
+            dispatch function. Only handleView gets a memoryview on the
+            stream instead, which is valid during the dispatch only.
+            Returns True if any message was dispatched.
         """
 
-        # An incomplete header is not quite interesting, wait for more
-        if len(self.stream) < 4:
-            return False
+        stream = self.stream
+        view = memoryview(stream)
+        pos, end = self.streampos, len(stream)
+        dispatched = False
 
-        if self.curtype is None:
-            self.curlen, self.curtype = unpack('!HH', self.stream[:4])
+        while self.isConnected() and end - pos >= MD_HEADER_SIZE:
+            length, _type = unpack_from('!HH', stream, pos)
 
             # This message header is rubbish, kill the connection.
-            r = mdValidateMessageHeader(self.curtype, self.curlen)
+            r = mdValidateMessageHeader(_type, length)
             if r != MDV_NO_VIOLATION:
                 return self.handleProtocolViolation(r)
 
-        # Dispatch message
-        if len(self.stream) >= self.curlen:
-            _type, length = self.curtype, self.curlen
-            self.curtype = self.curlen = None
-            message = self.stream[4:length]
-            self.stream = self.stream[length:]
+            # An incomplete message is not quite interesting, wait for more
+            if end - pos < length:
+                break
+
+            # Only a complete message uses up the budget
+            if self._fbudget is not None:
+                if self._fbudget <= 0:
+                    self.yieldRead()
+                    break
+                self._fbudget -= 1
+
+            message = view[pos + MD_HEADER_SIZE:pos + length]
+            pos += length
+            self.streampos = pos
+
+            dispatch, handler = self.handlers.get(_type, (None, None))
+            if dispatch != self.handleView:
+                message = message.tobytes()
 
             # Message conforms to protocol specifications?
             r = mdValidateMessage(message)
             if r != MDV_NO_VIOLATION:
                 return self.handleProtocolViolation(r)
 
-            if self.handlers.has_key(_type):
-                dispatch, handler = self.handlers[_type]
+            if dispatch is not None:
                 dispatch(message, handler)
             else:
                 self.onUnknown(_type, message)
+            dispatched = True
 
-            return True
+        # Release our views so the buffer can be resized again
+        message = view = None
+        if not self.isConnected():
+            return dispatched
 
-        return False
+        if pos == end:
+            del stream[:]
+            self.streampos = 0
+        elif pos >= self.STREAM_COMPACT_SIZE:
+            del stream[:pos]
+            self.streampos = 0
+
+        return dispatched
 
+    def _beginRead(self):
+        self._fbudget = self.FRAME_BUDGET
+
+    def onReadResume(self):
+        # Dispatch the messages held back by the frame budget
+        self.handleStream()
 
     def handleSendMessage(self, message, handler):
         """
@@ -183,6 +260,16 @@ class ManagedMDSocket(ManagedSocket):
         """
         handler(message)
 
+    def handleView(self, message, handler):
+        """
+            Internal Handler Dispatch function.
+
+            This function passes the memoryview on the stream buffer to the
+            handler without copying it. The view must not be kept after the
+            handler returns.
+        """
+        handler(message)
+
     def pollRecvActivity(self):
         """
             This method returns true if the socket received
@@ -239,6 +326,14 @@ class ManagedMDSocket(ManagedSocket):
         """
         self.handleProtocolViolation(MDV_UNIMPLEMENTED)
 
+    def onQuit(self, reason):
+        """
+            Called upon receiving a QUIT message, the peer is going away.
+
+            Default implementation closes the connection.
+        """
+        self.close()
+
     def onProtocolViolation(self, reason):
         """
             Called upon violation of the DCP protocl by the peer. After the
@@ -264,6 +359,12 @@ class ManagedMDSocket(ManagedSocket):
         """
         self.send(mdPackMessage(MD_REGISTER_OK, ''))
 
+    def sendRegisterFail(self, reason):
+        """
+            Let client know the registration failed, and why
+        """
+        self.send(mdPackMessage(MD_REGISTER_FAIL, reason))
+
     def sendPing(self, string):
         """
             Send a PING containing message 'string' to the peer.
@@ -276,6 +377,12 @@ class ManagedMDSocket(ManagedSocket):
         """
         self.send(mdPackMessage(MD_PONG, string))
 
+    def sendQuit(self, reason = ''):
+        """
+            Send a QUIT with 'reason' to the peer.
+        """
+        self.send(mdPackMessage(MD_QUIT, reason))
+
     def handleProtocolViolation(self, reason = None):
         """
             Handles a protocol violation.
@@ -293,3 +400,22 @@ class ManagedMDSocket(ManagedSocket):
         """
         return self.handleProtocolViolation(MDV_MANUAL_VIOLATION)
 
+# Microbenchmark of message validation, run as: python libmd/md.py
+if __name__ == '__main__':
+    from timeit import repeat
+
+    def naiveValidateMessage(message):
+        # The original per-character implementation, for comparison
+        for i in message:
+            if i not in md_charset:
+                return MDV_INVALID_MESSAGE
+        return MDV_NO_VIOLATION
+
+    stream = bytearray(mdPackMessage(MD_PING, 'x' * 196) * 16)
+    for name, message in (('short', 'hai'),
+            ('full', ('script output line\n' * 11)[:196]),
+            ('view', memoryview(stream)[4:200])):
+        assert naiveValidateMessage(message) == mdValidateMessage(message)
+        for func in (naiveValidateMessage, mdValidateMessage):
+            t = min(repeat(lambda: func(message), number = 100000, repeat = 3))
+            print '%-6s %-22s %.3f usec/call' % (name, func.__name__, t * 10)
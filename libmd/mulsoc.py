@@ -7,13 +7,21 @@
 """
 
 import socket
-from select import select, error as select_error
-from time import time
+from select import error as select_error
 import errno
-from events import DeadEventQueue, DeferredCall
+import os
+import fcntl
+import signal
+import stat
+from events import DeadEventQueue, DeferredCall, monotonic
+from poller import DefaultPoller, POLL_READ, POLL_WRITE
+from executor import ThreadExecutor, ProcessExecutor
+from resolver import Resolver
 from struct import calcsize, pack, unpack
 from fcntl import ioctl
 from array import array
+from collections import deque
+from itertools import islice
 
 # IO Control constants
 # These constants where taken from
@@ -23,6 +31,15 @@ SIOCGIFCONF = 0x8912
 SIOCGIFADDR = 0x8915
 IFNAMSIZ = 16
 
+# Socket option constants missing from older Python versions
+# These were taken from <asm-generic/socket.h>
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+# These were taken from <netinet/tcp.h>
+TCP_CORK = getattr(socket, 'TCP_CORK', 3)
+TCP_USER_TIMEOUT = getattr(socket, 'TCP_USER_TIMEOUT', 18)
+
 # ioctl communication structures
 
 # NOTE: To make the sizes of the structures compatible with C every size is
@@ -175,7 +192,100 @@ class CInterfaceConfig(object):
 
 del size2C
 
-class SocketMultiplexer(object):
+def peerCredentials(sock):
+    """
+        Returns the (pid, uid, gid) of the peer of connected unix domain
+        socket 'sock'.
+    """
+    return unpack('3i', sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+        calcsize('3i')))
+
+class Waker(object):
+    """
+        Self-pipe that wakes up a SocketMultiplexer waiting in its poller,
+        watched for reading like any other socket.
+    """
+
+    def __init__(self):
+        self._rfd, self._wfd = os.pipe()
+        for fd in (self._rfd, self._wfd):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+    def fileno(self):
+        return self._rfd
+
+    def wake(self):
+        """
+            Wake up the poller, this may be called from any thread.
+        """
+        try:
+            os.write(self._wfd, '\0')
+        except OSError, e:
+            # A full pipe will wake up the poller anyway
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                raise e
+
+    def handleRead(self):
+        """
+            Empty the pipe, the multiplexer does the actual work.
+        """
+        try:
+            while len(os.read(self._rfd, 4096)) == 4096:
+                pass
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                raise e
+        return True
+
+class BroadcastMixin(object):
+    """
+        Mixin providing broadcast() to multiplexers, for the sockets they
+        manage.
+    """
+
+    # Policies for slow consumers in broadcast(): queue the data anyway,
+    # leave them out, or treat them as stalled
+    SLOW_QUEUE, SLOW_SKIP, SLOW_STALL = range(3)
+
+    def broadcast(self, data, socks, slow = SLOW_SKIP):
+        """
+            Send 'data' to every connected socket in 'socks'.
+
+            The data is turned into an immutable string once, and that same
+            object is queued on every socket, so the cost per socket is that
+            of appending to its send queue.
+
+            Sockets with a paused send queue (see SEND_HIGH_WATER) are slow
+            consumers, they are handled according to 'slow': SLOW_QUEUE
+            queues the data anyway, SLOW_SKIP leaves them out and SLOW_STALL
+            also calls their onSendStall() once all sockets are done.
+
+            Returns the amount of sockets the data was queued on.
+        """
+        if type(data) is not str:
+            data = memoryview(data).tobytes()
+
+        # Sending may drop sockets from 'socks', so walk a snapshot
+        sent, stalled = 0, []
+        for sock in list(socks):
+            if not sock.isConnected():
+                continue
+            if sock.isSendPaused() and slow != self.SLOW_QUEUE:
+                if slow == self.SLOW_STALL:
+                    stalled.append(sock)
+                continue
+            sock.send(data)
+            sent += 1
+
+        for sock in stalled:
+            if sock.isConnected():
+                sock.onSendStall()
+        return sent
+
+class SocketMultiplexer(BroadcastMixin):
     """
         Abstract socket multiplexer, useful for managing lots of sockets
         with a single thread.
@@ -189,25 +299,79 @@ class SocketMultiplexer(object):
     LISTEN_QUEUE_MAXIMUM = socket.SOMAXCONN
     LISTEN_QUEUE_DEFAULT = min(16, socket.SOMAXCONN)
 
+    # Pool sizes for runInThread and runInProcess, None for the CPU count
+    THREAD_WORKERS = 4
+    PROCESS_WORKERS = None
+
+    # Seconds listeners stop accepting when the process is out of file
+    # descriptors and no pending connection could be shed
+    ACCEPT_RETRY_DELAY = 0.1
+
     class Deadlock(Exception):
         """
             This class represents the occurrence of a deadlock in the event
             processing system. (It would wait forever on nothing)
         """
 
-    def __init__(self, sock = None):
+    def __init__(self, sock = None, poller = None, eq = None):
         """
             Initialise a base SocketMultiplexer that uses 'sock' as its
             ManagedSocket instantiator.
+
+            'poller' can be used to override the readiness notification
+            backend, see poller.py. By default epoll is used when available.
+            'eq' can be used to override the event queue, for instance with
+            a TimingWheelQueue when lots of timers are used.
         """
 
         self._keep_running = False
         if sock is None:
             sock = ManagedSocket
         self._sock = sock
-        self.eq = DeadEventQueue()
+        if poller is None:
+            poller = DefaultPoller()
+        self._poller = poller
+        if eq is None:
+            eq = DeadEventQueue()
+        self.eq = eq
         self._alarm = None
-        self._reads, self._writes = [], []
+
+        # Registry of watched objects and their interest masks, both indexed
+        # by file descriptor. Changes are collected in '_changes' and handed
+        # to the poller in a single batch right before it is called.
+        self._socks, self._interest = {}, {}
+        self._changes = set()
+
+        # Receive buffer shared by all sockets of this multiplexer
+        self._rbuf = bytearray()
+
+        # Calls queued for execution on the multiplexer thread
+        self._callbacks = deque()
+        self._waker = Waker()
+        self.addReader(self._waker)
+
+        # Executors for blocking work, and the amount of calls they have yet
+        # to complete
+        self._threads = self._processes = None
+        self._outstanding = 0
+
+        # Signal handlers by signal number, the handlers they replaced, and
+        # the signals received but not yet handled. Signals are delivered
+        # through the waker, see addSignalHandler.
+        self._sighandlers, self._sigprevious = {}, {}
+        self._sigqueue = deque()
+
+        # Sockets with coalesced writes waiting to be flushed
+        self._dirty = []
+
+        # Sockets that used up their read budget, by file descriptor
+        self._pending = {}
+
+        self.resolver = Resolver(self)
+
+        # Descriptor kept open to be released when the process runs out of
+        # descriptors, see shedConnection
+        self._reserve = self._openReserve()
 
     def startMultiplex(self):
         """
@@ -217,72 +381,270 @@ class SocketMultiplexer(object):
         """
 
         self._keep_running = True
-        tick = None
+        self._tick = monotonic()
 
         try:
             while self._keep_running:
                 try:
 
                     # Handle the events system
-                    if self.eq.nextEventTicks() is None:
-                        tick = None
-                    elif tick is None:
-                        tick = time()
-                    else:
-                        newtick = time()
-                        if newtick - tick > 0.0:
-                            self.eq.elapseTime(newtick - tick)
-                        tick = newtick
-                        del newtick
+                    self.timeFlow()
 
                     # Guard against activity deadlocks
                     # They really shouldn't occur, but it is good practice to
-                    # catch them.
-                    if len(self._reads) + len(self._writes) == 0 and \
+                    # catch them. The waker alone does not count.
+                    if len(self._interest) == 1 and not self._callbacks and \
+                            not self._outstanding and \
                             self.eq.nextEventTicks() is None:
                         raise SocketMultiplexer.Deadlock("No events left")
 
                     # Wait for activity
-                    reads, writes, excepts = \
-                        select(self._reads, self._writes, [],
-                            self.eq.nextEventTicks())
+                    if self._dirty:
+                        self._flushWrites()
+                    self._flushChanges()
+                    ready = self._poller.poll(self._pollTimeout())
 
                     # Handle the events system
                     # I know this isn't the nicest solution, but
                     # this is required to fix a nasty bug triggering over
                     # execution.
-                    if self.eq.nextEventTicks() is None:
-                        tick = None
-                    elif tick is None:
-                        tick = time()
-                    else:
-                        newtick = time()
-                        if newtick - tick > 0.0:
-                            self.eq.elapseTime(newtick - tick)
-                        tick = newtick
-                        del newtick
-
-                except select_error, e:
-                    if e.args[0] == errno.EINTR:
+                    self.timeFlow()
+
+                except (select_error, IOError), e:
+                    if e.args[0] != errno.EINTR:
+                        raise e
+                    ready = ()
+
+                    # Interrupted by a signal without a registered handler
+                    if not self._sigqueue:
                         self.onSignal()
-                        continue
-                    raise e
+
+                # Handle signals before any other activity
+                if self._sigqueue:
+                    self._runSignals()
 
                 # Handle reads and writes
-                for r in reads: r.handleRead()
-                for w in writes: w.handleWrite()
+                # The registry is consulted for every event, since an
+                # earlier handler may have removed or replaced the socket.
+                # Sockets that used up their read budget are read after the
+                # others, once per iteration.
+                interest, socks = self._interest, self._socks
+                pending = self._pending
+                if pending:
+                    self._pending = {}
+                for fd, mask in ready:
+                    if mask & interest.get(fd, 0) & POLL_READ and \
+                            fd not in pending:
+                        socks[fd].handleRead()
+                    if mask & interest.get(fd, 0) & POLL_WRITE:
+                        socks[fd].handleWrite()
+                for sock in pending.itervalues():
+                    if sock.isConnected():
+                        sock.handleRead()
+
+                # Handle calls queued by handlers and other threads
+                if self._callbacks:
+                    self._runCallbacks()
         finally:
             self._keep_running = False
 
+            # Stop the pools once their work is done, so no thread is left
+            # waiting for work while the interpreter exits. They are started
+            # again on demand.
+            for executor in (self._threads, self._processes):
+                if executor is not None:
+                    executor.shutdown(True)
+            self._threads = self._processes = None
+
+        return True
+
+    def _pollTimeout(self):
+        """
+            Returns how long the poller may wait for activity.
+        """
+        if self._callbacks or self._sigqueue or self._pending:
+            return 0.0
+        return self.eq.nextEventTicks()
+
+    def scheduleFlush(self, sock):
+        """
+            Flush the send queue of 'sock' before the multiplexer waits for
+            activity again, see ManagedSocket.SEND_COALESCE.
+        """
+        self._dirty.append(sock)
+
+    def scheduleRead(self, sock):
+        """
+            Call the handleRead() method of 'sock' in the next iteration,
+            whether or not new data arrives. See ManagedSocket.yieldRead.
+        """
+        self._pending[sock.fileno()] = sock
+
+    def flush(self):
+        """
+            Flush all coalesced writes now, instead of before the next poll.
+        """
+        if self._dirty:
+            self._flushWrites()
+
+    def _flushWrites(self):
+        """
+            Flush every socket with coalesced writes once. Sockets that
+            become dirty while doing so, because of callbacks, are flushed as
+            well.
+        """
+        while self._dirty:
+            dirty, self._dirty = self._dirty, []
+            for sock in dirty:
+                sock._wdirty = False
+                sock.flush()
+
+    def _openReserve(self):
+        try:
+            fd = os.open(os.devnull, os.O_RDONLY)
+        except OSError, e:
+            if e.errno not in (errno.EMFILE, errno.ENFILE):
+                raise e
+            return None
+        fcntl.fcntl(fd, fcntl.F_SETFD,
+            fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        return fd
+
+    def shedConnection(self, listener):
+        """
+            Called by 'listener' when accepting failed because the process
+            or system is out of file descriptors. The pending connection would
+            keep the listener ready forever, so it is accepted with the
+            reserve descriptor and closed right away. Without a reserve the
+            listener stops accepting for ACCEPT_RETRY_DELAY seconds instead.
+        """
+        if self._reserve is None:
+            self._reserve = self._openReserve()
+        if self._reserve is None:
+            listener.pauseReading()
+            self.eq.scheduleEvent(DeferredCall(self.ACCEPT_RETRY_DELAY,
+                listener.resumeReading))
+            return False
+
+        os.close(self._reserve)
+        self._reserve = None
+        try:
+            try:
+                listener._sock.accept()[0].close()
+            except socket.error, e:
+                if e.args[0] not in (errno.EWOULDBLOCK, errno.EINTR,
+                        errno.ECONNABORTED, errno.EMFILE, errno.ENFILE):
+                    raise e
+        finally:
+            self._reserve = self._openReserve()
         return True
 
+    def callSoon(self, call, *args, **kargs):
+        """
+            Queue 'call' for execution on the next iteration of the
+            multiplexer loop. Only call this from the multiplexer thread.
+        """
+        self._callbacks.append((call, args, kargs))
+
+    def callSoonThreadsafe(self, call, *args, **kargs):
+        """
+            Queue 'call' for execution on the multiplexer thread, and wake
+            up the multiplexer. This may be called from any thread.
+        """
+        self._callbacks.append((call, args, kargs))
+        self._waker.wake()
+
+    def runInThread(self, call, *args, **kargs):
+        """
+            Execute the blocking 'call' on a pool thread.
+
+            Returns a LoopFuture, its callbacks are executed on the
+            multiplexer thread once the call completes.
+        """
+        if self._threads is None:
+            self._threads = ThreadExecutor(self, self.THREAD_WORKERS)
+        return self._threads.submit(call, *args, **kargs)
+
+    def runInProcess(self, call, *args, **kargs):
+        """
+            Execute the CPU bound 'call' in a pool process, 'call', its
+            arguments and its result must be picklable.
+
+            Returns a LoopFuture, its callbacks are executed on the
+            multiplexer thread once the call completes.
+        """
+        if self._processes is None:
+            self._processes = ProcessExecutor(self, self.PROCESS_WORKERS)
+        return self._processes.submit(call, *args, **kargs)
+
+    def _runCallbacks(self):
+        """
+            Execute the calls queued so far, calls queued while doing so are
+            left for the next iteration.
+        """
+        callbacks = self._callbacks
+        for i in xrange(len(callbacks)):
+            call, args, kargs = callbacks.popleft()
+            call(*args, **kargs)
+
+    def addSignalHandler(self, signum, handler):
+        """
+            Call 'handler' with the signal number on the multiplexer thread
+            whenever signal 'signum' is received. Only call this from the
+            main thread.
+
+            The signal is queued by a minimal Python level handler, while the
+            interpreter writes to the waker so that a waiting poller returns
+            right away, even if the signal arrives just before it is entered.
+        """
+        if signum not in self._sighandlers:
+            self._sigprevious[signum] = signal.signal(signum, self._onSignal)
+        self._sighandlers[signum] = handler
+        signal.set_wakeup_fd(self._waker._wfd)
+        return True
+
+    def delSignalHandler(self, signum):
+        """
+            Remove the handler of signal 'signum', restoring the handler it
+            replaced.
+        """
+        if signum not in self._sighandlers:
+            return False
+        del self._sighandlers[signum]
+        signal.signal(signum, self._sigprevious.pop(signum))
+        if not self._sighandlers:
+            signal.set_wakeup_fd(-1)
+        return True
+
+    def _onSignal(self, signum, frame):
+        self._sigqueue.append(signum)
+
+    def _runSignals(self):
+        """
+            Execute the handlers of the signals received so far, a signal
+            received several times is handled once.
+        """
+        signums, queue = set(), self._sigqueue
+        while queue:
+            signums.add(queue.popleft())
+        for signum in signums:
+            handler = self._sighandlers.get(signum)
+            if handler is not None:
+                handler(signum)
+
     def timeFlow(self):
         """
             Executes the flow of time.
 
-            This function will be used in the future to
-            prevent clock jumps and streamline the events system.
+            Elapses the time passed since the previous call on the event
+            queue. Time is taken from a monotonic clock, so clock jumps do
+            not affect the events system, and the queue keeps absolute
+            deadlines so this is cheap when no event expires.
         """
+        tick = monotonic()
+        if tick > self._tick:
+            self.eq.elapseTime(tick - self._tick)
+            self._tick = tick
 
     def stopMultiplex(self):
         """
@@ -297,6 +659,10 @@ class SocketMultiplexer(object):
         """
             Initiate a client connection to the specified server.
 
+            'ip' may also be a host name, which is resolved without blocking
+            through the resolver of the multiplexer before connecting. If
+            'port' is None 'ip' is the path of a unix domain socket instead.
+
             Additionally you can specify 'sock = <some class' in the
             function call to override the default socket instantiator.
             Any additional keywords shall be passed on to
@@ -308,15 +674,32 @@ class SocketMultiplexer(object):
         except KeyError:
             sock = self._sock
         new = sock(self, ip, port, **keywords)
-        new.connect()
+        if port is None:
+            new.connect()
+        else:
+            self.resolver.resolve(ip).addDoneCallback(
+                lambda f: self._connectResolved(new, f))
         return True
 
+    def _connectResolved(self, sock, future):
+        if future.exception() is not None:
+            sock.handleResolveFail()
+        else:
+            sock.connect(future.result())
+
     def listen(self, ip, port,
-            queue_length = None, **keywords):
+            queue_length = None, reuse_port = False, **keywords):
         """
             Create a new socket that will start listening on
             the specified address.
 
+            If 'reuse_port' is True the socket is bound with SO_REUSEPORT,
+            allowing several processes to listen on the same address with
+            the kernel spreading incoming connections over them.
+
+            If 'port' is None the socket listens on the unix domain socket
+            with path 'ip', see ManagedSocket.checkPeerCredentials.
+
             Additionally you can specify 'sock = <some class' in the
             function call to override the default socket instantiator.
             Any additional keywords shall be passed on to
@@ -330,7 +713,7 @@ class SocketMultiplexer(object):
         except KeyError:
             sock = self._sock
         new = sock(self, ip, port, **keywords)
-        if not new.listen(queue_length):
+        if not new.listen(queue_length, reuse_port):
             return False
         return True
 
@@ -338,40 +721,85 @@ class SocketMultiplexer(object):
         """
             Add socket to the list of sockets watched for reading
         """
-        if sock in self._reads:
-            return False
-        self._reads.append(sock)
-        return True
+        return self._addInterest(sock, POLL_READ)
 
     def delReader(self, sock):
         """
             Delete socket from the list of sockets watched for reading
         """
-        try:
-            self._reads.remove(sock)
-        except ValueError:
-            return False
-        return True
+        return self._delInterest(sock, POLL_READ)
 
     def addWriter(self, sock):
         """
             Add socket to the list of sockets watched for writing
         """
-        if sock in self._writes:
-            return False
-        self._writes.append(sock)
-        return True
+        return self._addInterest(sock, POLL_WRITE)
 
     def delWriter(self, sock):
         """
             Delete socket from the list of sockets watched for writing
         """
-        try:
-            self._writes.remove(sock)
-        except ValueError:
+        return self._delInterest(sock, POLL_WRITE)
+
+    def _addInterest(self, sock, flag):
+        """
+            Add 'flag' to the interest mask of 'sock', for internal use only.
+        """
+        fd = sock.fileno()
+        mask = self._interest.get(fd, 0)
+        if self._socks.get(fd) is not sock:
+            # A stale entry means the descriptor number has been reused
+            mask = 0
+        elif mask & flag:
             return False
+        self._socks[fd] = sock
+        self._interest[fd] = mask | flag
+        self._changes.add(fd)
         return True
 
+    def _delInterest(self, sock, flag):
+        """
+            Remove 'flag' from the interest mask of 'sock', for internal
+            use only.
+        """
+        fd = sock.fileno()
+        mask = self._interest.get(fd, 0)
+        if not mask & flag or self._socks[fd] is not sock:
+            return False
+        mask &= ~flag
+        if mask:
+            self._interest[fd] = mask
+        else:
+            del self._interest[fd]
+            del self._socks[fd]
+        self._changes.add(fd)
+        return True
+
+    def recvBuffer(self, size):
+        """
+            Returns the shared receive buffer, grown to at least 'size' bytes.
+
+            Data in this buffer is only valid until the next read.
+        """
+        if len(self._rbuf) < size:
+            self._rbuf = bytearray(size)
+        return self._rbuf
+
+    def _flushChanges(self):
+        """
+            Hand all pending interest changes to the poller.
+        """
+        if not self._changes:
+            return
+        interest, poller = self._interest, self._poller
+        for fd in self._changes:
+            mask = interest.get(fd, 0)
+            if mask:
+                poller.modify(fd, mask)
+            else:
+                poller.unregister(fd)
+        self._changes.clear()
+
     def setAlarm(self, seconds):
         """
             Sets an alarm that will occur in 'seconds' time, seconds may be
@@ -399,7 +827,8 @@ class SocketMultiplexer(object):
 
     def onSignal(self):
         """
-            Called when select() is interrupted by a signal.
+            Called when the poller is interrupted by a signal that has no
+            handler registered with addSignalHandler().
         """
 
 class ManagedSocket(object):
@@ -412,12 +841,62 @@ class ManagedSocket(object):
     WATCH_READ, WATCH_WRITE = [1, 2]
     UNBOUND, CONNECTING, CONNECTED, DISCONNECTED, LISTENING, CLOSED = range(6)
 
+    # Maximum amount of buffers handed to a single sendmsg() call
+    SEND_IOV_MAX = 1024
+
+    # Without sendmsg() small queued chunks are merged into a single chunk
+    # of at most this many bytes, so they still go out in one system call.
+    SEND_MERGE_SIZE = 65536
+
+    _has_sendmsg = hasattr(socket.socket, 'sendmsg')
+
+    # Bounds of the adaptive amount of bytes asked for per recv_into() call.
+    # The size doubles after every read that fills it and halves after a
+    # read that uses less than a quarter of it.
+    RECV_SIZE_MIN = 4096
+    RECV_SIZE_MAX = 262144
+
+    # Maximum amount of bytes read from a connection per multiplexer
+    # iteration, None for no limit. A socket over budget yields, so that a
+    # single busy peer cannot starve the others.
+    READ_BUDGET = None
+
+    # Maximum amount of clients a listening socket accepts per multiplexer
+    # iteration, clients left pending are reported again by the poller.
+    ACCEPT_BUDGET = 64
+
+    # With SEND_COALESCE send() only queues data, every connection is flushed
+    # once per multiplexer iteration so that all messages sent by handlers in
+    # the meantime leave in as few system calls as possible.
+    SEND_COALESCE = False
+
+    # Set TCP_NODELAY on connections, so the flushed data is not held back
+    # by Nagle's algorithm.
+    SEND_NODELAY = False
+
+    # Set TCP_CORK while a flush takes more than one system call, so that only
+    # full segments are sent. (Linux only)
+    SEND_CORK = False
+
+    # Send queue watermarks in bytes. onPause() is called once the queue
+    # grows beyond SEND_HIGH_WATER, onDrain() once it shrinks back to
+    # SEND_LOW_WATER. If the queue stays paused for SEND_STALL_TIMEOUT seconds
+    # onSendStall() is called. None disables the watermarks or the timeout.
+    SEND_HIGH_WATER = None
+    SEND_LOW_WATER = 0
+    SEND_STALL_TIMEOUT = None
+
+    # TCP keepalive tuning applied to connections, an (idle, interval, count)
+    # tuple in seconds, see setKeepAlive(). None keeps the system defaults.
+    KEEPALIVE = None
+
     def __init__(self, muxer, ip, port):
         """
             Instantiate an abstract managed socket.
 
             This method can be called in 2 ways:
-                the expected way, a muxer, an ip, and a port, or
+                the expected way, a muxer, an ip, and a port, or a muxer,
+                the path of a unix domain socket and None, or
 
                 the unexpected way, re-using an already connected socket
                 (that has been obtained through accepting).
@@ -428,17 +907,26 @@ class ManagedSocket(object):
 
         if type(ip) is tuple:
             self._sock = ip[0]
-            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-
-            # To prevent could not start listening bug?
-            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._family = self._sock.family
+            if self._family != socket.AF_UNIX:
+                self._sock.setsockopt(socket.SOL_SOCKET,
+                    socket.SO_KEEPALIVE, 1)
+                if self.SEND_NODELAY:
+                    self._sock.setsockopt(socket.IPPROTO_TCP,
+                        socket.TCP_NODELAY, 1)
+                if self.KEEPALIVE is not None:
+                    self.setKeepAlive(*self.KEEPALIVE)
 
             self._ip =  self._port = None
             self._peer_ip, self._peer_port = port
             self._state = ManagedSocket.CONNECTED
             muxer.addReader(self)
         else:
-            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if port is None:
+                self._family = socket.AF_UNIX
+            else:
+                self._family = socket.AF_INET
+            self._sock = socket.socket(self._family, socket.SOCK_STREAM)
             self._ip = ip
             self._port = port
             self._peer_ip =  self._peer_port = None
@@ -447,18 +935,37 @@ class ManagedSocket(object):
         # Setup common states
         self._sock.setblocking(0)
         self.muxer = muxer
-        self._wbuf = ''
+
+        # The send queue holds immutable chunks, '_woffset' is the amount of
+        # bytes of the first chunk that has already been sent.
+        self._wqueue = deque()
+        self._woffset = 0
+        self._wbytes = 0
 
         # Last write blocked flag, used for speeding up non-blocking writes
         self._lwb = False
 
+        # Set while the multiplexer is to flush coalesced writes
+        self._wdirty = False
+
+        # Watermark state, and the event that fires when the send queue has
+        # been over the high watermark for too long
+        self._wpaused = False
+        self._wstall = None
+
+        # Set by pauseReading(), respectively by yieldRead()
+        self._rpaused = False
+        self._ryield = False
+
+        self._rsize = self.RECV_SIZE_MIN
+
     def fileno(self):
         """
             Return this socket's file descriptor for waiting.
         """
         return self._sock.fileno()
 
-    def listen(self, queue_length):
+    def listen(self, queue_length, reuse_port = False):
         """
             Start listening for clients.
         """
@@ -466,9 +973,24 @@ class ManagedSocket(object):
         if self._state != ManagedSocket.UNBOUND:
             return False
         try:
-            # For now listen even if address is in use
-            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self._sock.bind((self._ip, self._port))
+            if self._family == socket.AF_UNIX:
+                # Remove the socket file left by a previous run, but not
+                # one a running server still accepts on. That is left for
+                # bind() to fail on.
+                try:
+                    if stat.S_ISSOCK(os.stat(self._ip).st_mode) and \
+                            not self._unixInUse():
+                        os.unlink(self._ip)
+                except OSError:
+                    pass
+                self._sock.bind(self._ip)
+            else:
+                # For now listen even if address is in use
+                self._sock.setsockopt(socket.SOL_SOCKET,
+                    socket.SO_REUSEADDR, 1)
+                if reuse_port:
+                    self._sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+                self._sock.bind((self._ip, self._port))
         except socket.error, e:
             error = e.args[0]
             if error != errno.EADDRINUSE and error != errno.EACCES:
@@ -480,14 +1002,41 @@ class ManagedSocket(object):
         self._state = ManagedSocket.LISTENING
         return True
 
-    def connect(self):
+    def _unixInUse(self):
+        """
+            Returns False if nobody listens on the unix socket path of this
+            socket, for internal use only.
+        """
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        probe.setblocking(0)
+        try:
+            probe.connect(self._ip)
+        except socket.error, e:
+            # A full backlog (EAGAIN) still means there is a listener
+            return e.args[0] != errno.ECONNREFUSED
+        finally:
+            probe.close()
+        return True
+
+    def connect(self, ip = None):
         """
             Start connecting to client.
+
+            'ip' replaces the address given on construction, which is used
+            after resolving a host name.
         """
 
         if self._state != ManagedSocket.UNBOUND:
             return False
-        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if ip is not None:
+            self._ip = ip
+        if self._family != socket.AF_UNIX:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if self.SEND_NODELAY:
+                self._sock.setsockopt(socket.IPPROTO_TCP,
+                    socket.TCP_NODELAY, 1)
+            if self.KEEPALIVE is not None:
+                self.setKeepAlive(*self.KEEPALIVE)
         self._peer_ip, self._listening_port = self._ip, self._port
         self.handleConnect()
 
@@ -507,16 +1056,24 @@ class ManagedSocket(object):
             self.muxer.addWriter(self)
 
         try:
-            self._sock.connect((self._ip, self._port))
-            self._state = ManagedSocket.CONNECTED
-            self._ip, self._port = self._sock.getsockname()
-            self._peer_ip, self._peer_port = self._sock.getpeername()
-            self.onConnect()
+            if self._family == socket.AF_UNIX:
+                self._sock.connect(self._ip)
+                self._state = ManagedSocket.CONNECTED
+            else:
+                self._sock.connect((self._ip, self._port))
+                self._state = ManagedSocket.CONNECTED
+                self._ip, self._port = self._sock.getsockname()
+                self._peer_ip, self._peer_port = self._sock.getpeername()
+
+            # Drop the connect interest before onConnect(), a send() in there
+            # that blocks has to be able to register it again.
             self.muxer.addReader(self)
             self.muxer.delWriter(self)
+            self.onConnect()
         except socket.error, e:
             error = e.args[0]
-            if error in (errno.ECONNREFUSED, errno.ETIMEDOUT, errno.ECONNRESET):
+            if error in (errno.ECONNREFUSED, errno.ETIMEDOUT, errno.ECONNRESET,
+                    errno.ENOENT):
                 self._state = ManagedSocket.DISCONNECTED
                 self.muxer.delWriter(self)
                 self.onConnectionRefuse()
@@ -527,21 +1084,54 @@ class ManagedSocket(object):
                 raise e
         return True
 
+    def handleResolveFail(self):
+        """
+            Internal function called when the host name to connect to
+            could not be resolved.
+        """
+        if self._state != ManagedSocket.UNBOUND:
+            return False
+        self._state = ManagedSocket.DISCONNECTED
+        self.onResolveFail()
+        return True
+
     def handleRead(self):
         """
             Internal function that mediates non-blocking reads.
         """
 
         # Read data
-        data = ''
-        d = ''
+        n = None
         if self._state == ManagedSocket.CONNECTED:
+            self._beginRead()
+
+            # Finish the work held back in the previous iteration first
+            if self._ryield:
+                self._ryield = False
+                self.onReadResume()
+                if self._ryield:
+                    if self._state == ManagedSocket.CONNECTED:
+                        self.muxer.scheduleRead(self)
+                    return True
+
+            budget = self.READ_BUDGET
+            buf = self.muxer.recvBuffer(self.RECV_SIZE_MAX)
+            view = memoryview(buf)
             try:
-                while self._state == ManagedSocket.CONNECTED:
-                    d = self._sock.recv(4096)
-                    if d == '':
+                while self._state == ManagedSocket.CONNECTED and \
+                        not self._rpaused and not self._ryield:
+                    n = self._sock.recv_into(buf, self._rsize)
+                    if n == 0:
                         break
-                    data += d
+                    if n == self._rsize:
+                        self._rsize = min(n << 1, self.RECV_SIZE_MAX)
+                    elif n < self._rsize >> 2:
+                        self._rsize = max(self._rsize >> 1, self.RECV_SIZE_MIN)
+                    self.onRecv(view[:n])
+                    if budget is not None:
+                        budget -= n
+                        if budget <= 0:
+                            self._ryield = True
             except socket.error, e:
                 error = e.args[0]
                 if error == errno.ECONNRESET or error == errno.ETIMEDOUT:
@@ -553,27 +1143,39 @@ class ManagedSocket(object):
                 elif error != errno.EWOULDBLOCK and error != errno.EINTR:
                     raise e
 
-            if data != '':
-                self.onRecv(data)
-
             # Connection lost or shutdown
-            if d =='' and self._state == ManagedSocket.CONNECTED:
+            if n == 0 and self._state == ManagedSocket.CONNECTED:
                 self.muxer.delReader(self)
                 if self._lwb:
                     self.muxer.delWriter(self)
                 self._state = ManagedSocket.DISCONNECTED
                 self.onDisconnect()
+            elif self._ryield and self._state == ManagedSocket.CONNECTED:
+                self.muxer.scheduleRead(self)
             return True
 
-        # Accept a new client
+        # Accept new clients
         elif self._state == ManagedSocket.LISTENING:
             try:
-                while self._state == ManagedSocket.LISTENING:
+                for i in xrange(self.ACCEPT_BUDGET):
+                    if self._state != ManagedSocket.LISTENING or \
+                            self._rpaused:
+                        break
                     conn, addr = self._sock.accept()
+                    if self._family == socket.AF_UNIX:
+                        if not self.checkPeerCredentials(
+                                *peerCredentials(conn)):
+                            conn.close()
+                            continue
+                        addr = (self._ip, None)
                     self.onAccept(self.muxer._sock(self.muxer, (conn,), addr))
             except socket.error, e:
                 error = e.args[0]
-                if error not in (errno.EWOULDBLOCK, errno.EINTR, errno.EMFILE):
+                if error == errno.EMFILE or error == errno.ENFILE:
+                    self.muxer.shedConnection(self)
+                    self.onAcceptOverload()
+                elif error not in (errno.EWOULDBLOCK, errno.EINTR,
+                        errno.ECONNABORTED):
                     raise e
 
             return True
@@ -591,10 +1193,17 @@ class ManagedSocket(object):
         elif self._state != ManagedSocket.CONNECTED:
             return False
 
-        while len(self._wbuf) and self._state == ManagedSocket.CONNECTED:
+        while self._wqueue and self._state == ManagedSocket.CONNECTED:
             try:
-                x = self._sock.send(self._wbuf[:4096])
-                self._wbuf = self._wbuf[x:]
+                if self._has_sendmsg:
+                    bufs = [memoryview(self._wqueue[0])[self._woffset:]]
+                    bufs.extend(islice(self._wqueue, 1, self.SEND_IOV_MAX))
+                    x = self._sock.sendmsg(bufs)
+                else:
+                    self._mergeSendQueue()
+                    x = self._sock.send(
+                        memoryview(self._wqueue[0])[self._woffset:])
+                self._consumeSendQueue(x)
             except socket.error, e:
                 error = e.args[0]
 
@@ -606,7 +1215,7 @@ class ManagedSocket(object):
                     if self._lwb:
                         self.muxer.delWriter(self)
                     self.onDisconnect()
-                    self._wbuf = ''
+                    self._clearSendQueue()
                     return False
                 elif error == errno.EWOULDBLOCK:
                     if not self._lwb:
@@ -616,23 +1225,198 @@ class ManagedSocket(object):
                     raise e
                 break
 
-        if not len(self._wbuf) and self._lwb:
+        if not self._wqueue and self._lwb:
+            self._lwb = False
             self.muxer.delWriter(self)
 
+        if self._wpaused and self._wbytes <= self.SEND_LOW_WATER and \
+                self._state == ManagedSocket.CONNECTED:
+            self._resumeSend()
+            self.onDrain()
+
         return True
 
+    def _pauseSend(self):
+        """
+            Enter the paused state of the send queue watermarks.
+        """
+        self._wpaused = True
+        if self.SEND_STALL_TIMEOUT is not None:
+            self._wstall = DeferredCall(self.SEND_STALL_TIMEOUT,
+                self.handleSendStall)
+            self.muxer.eq.scheduleEvent(self._wstall)
+
+    def _resumeSend(self):
+        """
+            Leave the paused state of the send queue watermarks.
+        """
+        self._wpaused = False
+        if self._wstall is not None:
+            self.muxer.eq.cancelEvent(self._wstall)
+            self._wstall = None
+
+    def handleSendStall(self):
+        """
+            Internal function called when the send queue has been over the
+            high watermark for SEND_STALL_TIMEOUT seconds.
+        """
+        self._wstall = None
+        if self._wpaused and self._state == ManagedSocket.CONNECTED:
+            self.onSendStall()
+
+    def _consumeSendQueue(self, x):
+        """
+            Drop 'x' sent bytes from the front of the send queue.
+        """
+        self._wbytes -= x
+        x += self._woffset
+        q = self._wqueue
+        while q and x >= len(q[0]):
+            x -= len(q.popleft())
+        self._woffset = x
+
+    def _mergeSendQueue(self):
+        """
+            Merge small chunks at the front of the send queue, for platforms
+            without scatter-gather sends. Every byte is copied at most once.
+        """
+        q = self._wqueue
+        if len(q) < 2 or len(q[0]) - self._woffset >= self.SEND_MERGE_SIZE:
+            return
+        head = q.popleft()
+        chunks = [head[self._woffset:] if self._woffset else head]
+        size = len(chunks[0])
+        while q and size + len(q[0]) <= self.SEND_MERGE_SIZE:
+            size += len(q[0])
+            chunks.append(q.popleft())
+        q.appendleft(''.join(chunks))
+        self._woffset = 0
+
+    def _clearSendQueue(self):
+        self._wqueue.clear()
+        self._woffset = self._wbytes = 0
+        if self._wpaused:
+            self._resumeSend()
+
     def send(self, data):
         """
             Place data in the output buffer for sending. All data will be
             sent ASAP to the peer socket.
+
+            The send queue keeps a reference to 'data' until it is sent, any
+            mutable buffer is therefore copied first.
         """
 
         if self._state != ManagedSocket.CONNECTED:
             return False
-        self._wbuf += data
-        self.handleWrite()
+        if type(data) is not str:
+            data = memoryview(data).tobytes()
+        if data:
+            self._wqueue.append(data)
+            self._wbytes += len(data)
+
+        # If the last write blocked the poller will tell us when to continue
+        if not self._lwb:
+            if not self.SEND_COALESCE:
+                self.handleWrite()
+            elif not self._wdirty:
+                self._wdirty = True
+                self.muxer.scheduleFlush(self)
+
+        if not self._wpaused and self.SEND_HIGH_WATER is not None and \
+                self._wbytes > self.SEND_HIGH_WATER and \
+                self._state == ManagedSocket.CONNECTED:
+            self._pauseSend()
+            self.onPause()
         return self._state == ManagedSocket.CONNECTED
 
+    def setKeepAlive(self, idle, interval, count, user_timeout = None):
+        """
+            Let the kernel detect dead peers. After 'idle' seconds without
+            traffic a keepalive probe is sent every 'interval' seconds, and
+            the connection is dropped after 'count' unanswered probes.
+
+            Keepalive probes are not sent while data is unacknowledged, so
+            TCP_USER_TIMEOUT limits how long sent data may stay so, in
+            seconds. It defaults to the time keepalive takes to give up.
+            A dead peer is reported through onDisconnect(). Options that are
+            not available on this platform are skipped.
+        """
+        if self._family == socket.AF_UNIX or self._sock is None:
+            return False
+        if user_timeout is None:
+            user_timeout = idle + interval * count
+
+        sock = self._sock
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for name, value in (('TCP_KEEPIDLE', idle),
+                ('TCP_KEEPINTVL', interval), ('TCP_KEEPCNT', count)):
+            if hasattr(socket, name):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name),
+                    int(value))
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, TCP_USER_TIMEOUT,
+                int(user_timeout * 1000))
+        except socket.error, e:
+            if e.args[0] not in (errno.ENOPROTOOPT, errno.EINVAL):
+                raise e
+        return True
+
+    def _beginRead(self):
+        """
+            Called once per multiplexer iteration before a connected socket
+            reads, subclasses reset their per iteration budgets here.
+        """
+
+    def yieldRead(self):
+        """
+            Stop reading for this multiplexer iteration, call this from
+            onRecv(). In the next iteration onReadResume() is called first,
+            even if no new data arrives, then reading continues.
+        """
+        self._ryield = True
+
+    def pauseReading(self):
+        """
+            Stop reading from the socket until resumeReading() is called,
+            so a peer that keeps sending is held back by TCP flow control.
+            A listening socket stops accepting clients.
+        """
+        if self._rpaused:
+            return False
+        self._rpaused = True
+        if self._state in (ManagedSocket.CONNECTED, ManagedSocket.LISTENING):
+            self.muxer.delReader(self)
+        return True
+
+    def resumeReading(self):
+        """
+            Resume reading after pauseReading().
+        """
+        if not self._rpaused:
+            return False
+        self._rpaused = False
+        if self._state in (ManagedSocket.CONNECTED, ManagedSocket.LISTENING):
+            self.muxer.addReader(self)
+        return True
+
+    def flush(self):
+        """
+            Send the queued data now, as far as the socket accepts it.
+        """
+
+        if self._state != ManagedSocket.CONNECTED or self._lwb or \
+                not self._wqueue:
+            return False
+
+        cork = self.SEND_CORK and len(self._wqueue) > 1
+        if cork:
+            self._sock.setsockopt(socket.IPPROTO_TCP, TCP_CORK, 1)
+        self.handleWrite()
+        if cork and self._state == ManagedSocket.CONNECTED:
+            self._sock.setsockopt(socket.IPPROTO_TCP, TCP_CORK, 0)
+        return True
+
     def close(self):
         """
             Close socket, you should delete this socket after closing, it will
@@ -642,6 +1426,16 @@ class ManagedSocket(object):
         if self._state == ManagedSocket.CLOSED:
             return False
 
+        if self._state == ManagedSocket.CONNECTED:
+
+            # Coalesced writes are not to be lost. A flush that finds the
+            # connection lost calls onDisconnect(), which may close this
+            # socket itself.
+            if self._wdirty:
+                self.flush()
+                if self._state == ManagedSocket.CLOSED:
+                    return True
+
         if self._state == ManagedSocket.CONNECTED:
 
             # There are some rare conditions in which our socket has become
@@ -660,6 +1454,14 @@ class ManagedSocket(object):
             self.muxer.delWriter(self)
         elif self._state == ManagedSocket.LISTENING:
             self.muxer.delReader(self)
+            if self._family == socket.AF_UNIX:
+                try:
+                    os.unlink(self._ip)
+                except OSError:
+                    pass
+
+        if self._wpaused:
+            self._resumeSend()
 
         self._sock.close()
         self._sock = None
@@ -821,6 +1623,15 @@ http://code.activestate.com/recipes/439093-get-names-of-all-up-network-interface
         """
         return self._peer_port
 
+    def peerCredentials(self):
+        """
+            This returns the (pid, uid, gid) of the peer of a connected unix
+            domain socket, or None for other sockets.
+        """
+        if self._family != socket.AF_UNIX or not self.isConnected():
+            return None
+        return peerCredentials(self._sock)
+
     def peerListeningPort(self):
         """
             This method returns the port used in a connect() call,
@@ -831,7 +1642,7 @@ http://code.activestate.com/recipes/439093-get-names-of-all-up-network-interface
         return self._listening_port
 
     def bytesInSendQueue(self):
-        return len(self._wbuf)
+        return self._wbytes
 
     # Various functions for determining the state of the socket
     def isConnected(self):
@@ -846,10 +1657,29 @@ http://code.activestate.com/recipes/439093-get-names-of-all-up-network-interface
     def isBound(self):
         return self._state != ManagedSocket.UNBOUND
 
+    def isUnix(self):
+        return self._family == socket.AF_UNIX
+
+    def isSendPaused(self):
+        return self._wpaused
+
+    def isReadPaused(self):
+        return self._rpaused
+
     # Callbacks
     def onRecv(self, data):
         """
             This callback is called on incoming data.
+
+            'data' is a memoryview on a receive buffer that is reused for the
+            next read, copy whatever has to be kept around.
+        """
+
+    def onReadResume(self):
+        """
+            Called in the iteration after yieldRead(), before any new data
+            is read. Continue the work held back here, calling yieldRead()
+            again postpones reading once more.
         """
 
     def onDisconnect(self):
@@ -862,6 +1692,33 @@ http://code.activestate.com/recipes/439093-get-names-of-all-up-network-interface
             Called when a pending connection is refused by the server.
         """
 
+    def onPause(self):
+        """
+            Called when the send queue grows beyond SEND_HIGH_WATER. Producers
+            should stop sending, for instance by calling pauseReading() on
+            the socket the data comes from.
+        """
+
+    def onDrain(self):
+        """
+            Called when the send queue of a paused socket has shrunk to
+            SEND_LOW_WATER, producers may continue.
+        """
+
+    def onSendStall(self):
+        """
+            Called when the send queue stayed over SEND_HIGH_WATER for
+            SEND_STALL_TIMEOUT seconds. Close the socket here to drop peers
+            that do not read.
+        """
+
+    def onResolveFail(self):
+        """
+            Called when the host name to connect to could not be resolved.
+            By default this is treated as a refused connection.
+        """
+        self.onConnectionRefuse()
+
     def onConnect(self):
         """
             Called when successfully connected to a server.
@@ -873,3 +1730,18 @@ http://code.activestate.com/recipes/439093-get-names-of-all-up-network-interface
             listening. 'sock' is the accepted socket.
         """
 
+    def checkPeerCredentials(self, pid, uid, gid):
+        """
+            Called on a listening unix domain socket for every client with
+            the credentials of the client process, return False to refuse
+            the client. By default only processes of the same user and of
+            root are accepted.
+        """
+        return uid == 0 or uid == os.getuid()
+
+    def onAcceptOverload(self):
+        """
+            Called on a listening socket when a client could not be accepted
+            because the process is out of file descriptors.
+        """
+
@@ -0,0 +1,163 @@
+# poller.py - Readiness notification backends
+"""
+    Poller backends
+
+    This file implements the readiness notification backends used by the
+    SocketMultiplexer. Every poller watches file descriptors for a mask of
+    POLL_READ and POLL_WRITE interest, and returns the descriptors that
+    became ready. The epoll backend is used on Linux, select is kept as
+    a portable fallback.
+"""
+
+import select
+import errno
+
+# Interest / readiness flags, equal to ManagedSocket.WATCH_READ and WATCH_WRITE
+POLL_READ, POLL_WRITE = 1, 2
+
+class SelectPoller(object):
+    """
+        Poller based on select(), limited to FD_SETSIZE descriptors and
+        O(n) in the number of registered descriptors per call.
+    """
+
+    def __init__(self):
+        self._reads, self._writes = set(), set()
+
+    def register(self, fd, mask):
+        """
+            Start watching 'fd' for the events in 'mask'.
+        """
+        self.modify(fd, mask)
+
+    def modify(self, fd, mask):
+        """
+            Change the events watched for on 'fd'.
+        """
+        if mask & POLL_READ:
+            self._reads.add(fd)
+        else:
+            self._reads.discard(fd)
+        if mask & POLL_WRITE:
+            self._writes.add(fd)
+        else:
+            self._writes.discard(fd)
+
+    def unregister(self, fd):
+        """
+            Stop watching 'fd'.
+        """
+        self._reads.discard(fd)
+        self._writes.discard(fd)
+
+    def poll(self, timeout = None):
+        """
+            Wait at most 'timeout' seconds (forever if None) and return a
+            list of (fd, mask) tuples of the descriptors that are ready.
+        """
+        reads, writes, excepts = select.select(self._reads, self._writes, [],
+            timeout)
+        ready = {}
+        for fd in reads:
+            ready[fd] = POLL_READ
+        for fd in writes:
+            ready[fd] = ready.get(fd, 0) | POLL_WRITE
+        return ready.items()
+
+    def close(self):
+        self._reads.clear()
+        self._writes.clear()
+
+class EpollPoller(object):
+    """
+        Poller based on Linux epoll. Registration is kept in the kernel,
+        so the cost of a call only depends on the amount of ready
+        descriptors.
+    """
+
+    # Errors and hangups are reported as readiness for the events the
+    # descriptor is interested in, so that the handlers notice them.
+    _READ_EVENTS = select.EPOLLIN | select.EPOLLPRI \
+        if hasattr(select, 'epoll') else 0
+    _ERROR_EVENTS = select.EPOLLERR | select.EPOLLHUP \
+        if hasattr(select, 'epoll') else 0
+
+    def __init__(self):
+        self._epoll = select.epoll()
+        self._masks = {}
+
+    def _toEpoll(self, mask):
+        events = 0
+        if mask & POLL_READ:
+            events |= select.EPOLLIN
+        if mask & POLL_WRITE:
+            events |= select.EPOLLOUT
+        return events
+
+    def register(self, fd, mask):
+        """
+            Start watching 'fd' for the events in 'mask'.
+        """
+        try:
+            self._epoll.register(fd, self._toEpoll(mask))
+        except IOError, e:
+            if e.errno != errno.EEXIST:
+                raise e
+            self._epoll.modify(fd, self._toEpoll(mask))
+        self._masks[fd] = mask
+
+    def modify(self, fd, mask):
+        """
+            Change the events watched for on 'fd'.
+        """
+        try:
+            self._epoll.modify(fd, self._toEpoll(mask))
+        except IOError, e:
+            # The kernel drops closed descriptors by itself, a descriptor
+            # number that was reused has to be registered again.
+            if e.errno != errno.ENOENT:
+                raise e
+            self._epoll.register(fd, self._toEpoll(mask))
+        self._masks[fd] = mask
+
+    def unregister(self, fd):
+        """
+            Stop watching 'fd'.
+        """
+        self._masks.pop(fd, None)
+        try:
+            self._epoll.unregister(fd)
+        except IOError, e:
+            if e.errno not in (errno.ENOENT, errno.EBADF):
+                raise e
+
+    def poll(self, timeout = None):
+        """
+            Wait at most 'timeout' seconds (forever if None) and return a
+            list of (fd, mask) tuples of the descriptors that are ready.
+        """
+        if timeout is None:
+            timeout = -1
+        else:
+            timeout = max(timeout, 0.0)
+        ready = []
+        for fd, events in self._epoll.poll(timeout):
+            mask = 0
+            if events & self._READ_EVENTS:
+                mask |= POLL_READ
+            if events & select.EPOLLOUT:
+                mask |= POLL_WRITE
+            if events & self._ERROR_EVENTS:
+                mask |= self._masks.get(fd, 0)
+            ready.append((fd, mask))
+        return ready
+
+    def close(self):
+        self._epoll.close()
+        self._masks.clear()
+
+# Choose the best backend available on this platform
+if hasattr(select, 'epoll'):
+    DefaultPoller = EpollPoller
+else:
+    DefaultPoller = SelectPoller
@@ -0,0 +1,87 @@
+# resolver.py - Asynchronous name resolution
+"""
+    Asynchronous name resolution
+
+    This file implements a host name resolver for the SocketMultiplexer.
+    Lookups run on the multiplexer's thread pool, results are cached with a
+    positive and a negative TTL, and concurrent lookups of the same host
+    share a single query.
+"""
+
+import socket
+from events import monotonic
+from executor import LoopFuture
+
+class Resolver(object):
+    """
+        Caching IPv4 host name resolver.
+    """
+
+    # Seconds a successful respectively failed lookup is cached
+    POSITIVE_TTL = 300.0
+    NEGATIVE_TTL = 30.0
+
+    # Maximum amount of cached hosts
+    CACHE_SIZE = 1024
+
+    def __init__(self, muxer):
+        self.muxer = muxer
+        self._cache = {}
+        self._pending = {}
+
+    def resolve(self, host):
+        """
+            Returns a LoopFuture for the IPv4 address of 'host'. Addresses and
+            cached hosts give a future that is already done.
+        """
+        try:
+            socket.inet_pton(socket.AF_INET, host)
+            return self._completed(host, None)
+        except socket.error:
+            pass
+
+        entry = self._cache.get(host)
+        if entry is not None:
+            if entry[0] > monotonic():
+                return self._completed(entry[1], entry[2])
+            del self._cache[host]
+
+        # Coalesce with a lookup that is already running
+        future = self._pending.get(host)
+        if future is None:
+            future = self.muxer.runInThread(socket.gethostbyname, host)
+            self._pending[host] = future
+            future.addDoneCallback(lambda f: self._resolved(host, f))
+        return future
+
+    def _completed(self, ip, error):
+        future = LoopFuture()
+        if error is not None:
+            future.setException(error)
+        else:
+            future.setResult(ip)
+        return future
+
+    def _resolved(self, host, future):
+        del self._pending[host]
+
+        if len(self._cache) >= self.CACHE_SIZE:
+            self.purge()
+
+        error = future.exception()
+        if error is not None:
+            self._cache[host] = (monotonic() + self.NEGATIVE_TTL, None, error)
+        else:
+            self._cache[host] = (monotonic() + self.POSITIVE_TTL,
+                future.result(), None)
+
+    def purge(self):
+        """
+            Drop expired entries, or the whole cache if none expired.
+        """
+        now = monotonic()
+        for host, entry in self._cache.items():
+            if entry[0] <= now:
+                del self._cache[host]
+        if len(self._cache) >= self.CACHE_SIZE:
+            self._cache.clear()
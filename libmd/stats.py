@@ -0,0 +1,92 @@
+# stats.py - Latency statistics
+"""
+    Latency statistics
+
+    This file implements a compact histogram for latency measurements such
+    as round trip times. Samples are counted in exponentially growing
+    buckets, so memory use is fixed and percentiles are accurate to the
+    bucket growth factor.
+"""
+
+from math import log
+
+class Histogram(object):
+    """
+        Histogram with logarithmic buckets of samples between 'low' and
+        'high', values outside that range are counted in the outer buckets.
+
+        With 'window' the counts are halved whenever that many samples have
+        been added, so old samples fade out and the histogram follows
+        changes in latency.
+    """
+
+    def __init__(self, low = 0.0001, high = 60.0, growth = 1.25,
+            window = None):
+        self.low = low
+        self.growth = growth
+        self._scale = 1.0 / log(growth)
+        self.buckets = [0] * (self._index(high) + 1)
+        self.window = window
+        self.count = 0
+        self.total = 0.0
+
+    def _index(self, value):
+        if value <= self.low:
+            return 0
+        return int(log(value / self.low) * self._scale) + 1
+
+    def add(self, value):
+        """
+            Count a sample.
+        """
+        i = min(self._index(value), len(self.buckets) - 1)
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += value
+
+        if self.window is not None and self.count >= self.window:
+            self.decay()
+
+    def decay(self):
+        """
+            Halve all counts.
+        """
+        if not self.count:
+            return
+        mean = self.total / self.count
+        self.buckets = [n >> 1 for n in self.buckets]
+        self.count = sum(self.buckets)
+        self.total = mean * self.count
+
+    def mean(self):
+        """
+            Returns the mean sample, or None without samples.
+        """
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def percentile(self, p):
+        """
+            Returns the upper bound of the bucket holding the 'p' percentile
+            sample, or None without samples.
+        """
+        if not self.count:
+            return None
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                return self.low * self.growth ** i
+        return self.low * self.growth ** (len(self.buckets) - 1)
+
+    def summary(self):
+        """
+            Returns a short description of the distribution in milliseconds.
+        """
+        if not self.count:
+            return 'no samples'
+        return 'n=%i mean=%.1fms p50=%.1fms p90=%.1fms p99=%.1fms' % (
+            self.count, self.mean() * 1000, self.percentile(50) * 1000,
+            self.percentile(90) * 1000, self.percentile(99) * 1000)
@@ -1,8 +1,18 @@
 #!/usr/bin/env python
 import sys
+import os
+import errno
+import signal
+import traceback
+from select import select, error as select_error
+from random import uniform
+from collections import OrderedDict
 
 from libmd import SocketMultiplexer, ManagedMDSocket, PeriodicCall, DeferredCall
 from libmd.md import *
+from libmd.events import TimingWheelQueue, monotonic
+from libmd.mulsoc import Waker
+from libmd.stats import Histogram
 
 
 # Log levels
@@ -18,40 +28,304 @@ LVL_DEBUG = 9001        # What variables contain
 PING_RUN_PERIOD = 10                    # Time between ping rounds
 PING_TIMEOUT = 5.0                      # Ping response timeout
 
+# Ping timeouts are scaled from the observed round trip times: a multiple of
+# the 99th percentile RTT of the client, or of all clients while the client
+# has too few samples, bounded by PING_TIMEOUT_MIN and PING_TIMEOUT.
+PING_TIMEOUT_MIN = 1.0
+PING_RTT_FACTOR = 4.0
+PING_RTT_SAMPLES = 8
+
+# Pings are put off by up to PING_JITTER seconds at random, so that clients
+# that were active at the same time are not all pinged at once.
+PING_JITTER = PING_RUN_PERIOD / 4.0
+
+# TCP keepalive used to detect dead clients in keepalive mode:
+# idle time, probe interval and probe count.
+KEEPALIVE = (60, 10, 5)
+
+# Connections have to register within REGISTER_TIMEOUT seconds, and at most
+# MAX_PENDING connections may wait to register. Beyond that the connection
+# that has waited longest is dropped.
+REGISTER_TIMEOUT = 10.0
+MAX_PENDING = 1024
+REAP_PERIOD = 1.0
+
 if PING_TIMEOUT >= PING_RUN_PERIOD:
     print 'err: PING_RUN_PERIOD <= PING_TIMEOUT'
     sys.exit(1)
 
-class MDServer(SocketMultiplexer):
+class SessionRegistry(object):
+    '''
+        Registered clients, indexed by name and by socket.
+
+        Clients are also kept in a set per state, and in order of their last
+        activity, so that jobs find the clients they have to act on without
+        walking all clients. Connections that did not register yet are kept
+        in order of arrival. All operations are O(1).
+    '''
+
+    # Client states
+    REGISTERED, AWAITING_PONG = range(2)
 
     def __init__(self):
-        print 'MDServer init'    
-        SocketMultiplexer.__init__(self, MDSocket)
+        self.name2sock = {}
+        self.sock2name = {}
+        self.states = {
+            SessionRegistry.REGISTERED      : set(),
+            SessionRegistry.AWAITING_PONG   : set()
+        }
 
-        self.client2sock = {}
+        # Socket -> time of last activity, least recently active first
+        self.idle = OrderedDict()
 
-    def run(self, port):
-        """
+        # Unregistered socket -> time of arrival, oldest first
+        self.pending = OrderedDict()
+
+    def addPending(self, sock, limit = None):
+        '''
+            Add connection 'sock' that has yet to register. If more than
+            'limit' connections are pending, the oldest is removed and
+            returned so that it can be dropped.
+        '''
+        self.pending[sock] = monotonic()
+        if limit is not None and len(self.pending) > limit:
+            return self.pending.popitem(last = False)[0]
+        return None
+
+    def discardPending(self, sock):
+        self.pending.pop(sock, None)
+
+    def expiredPending(self, timeout):
+        '''
+            Returns the pending connections that have waited 'timeout'
+            seconds or longer, oldest first.
+        '''
+        expired = []
+        deadline = monotonic() - timeout
+        for sock, since in self.pending.iteritems():
+            if since > deadline:
+                break
+            expired.append(sock)
+        return expired
+
+    def register(self, name, sock):
+        '''
+            Register client 'sock' as 'name'. Returns False, changing
+            nothing, if the name is taken or the client is registered
+            already.
+        '''
+        if name in self.name2sock or sock in self.sock2name:
+            return False
+        self.pending.pop(sock, None)
+        self.name2sock[name] = sock
+        self.sock2name[sock] = name
+        self.states[SessionRegistry.REGISTERED].add(sock)
+        self.idle[sock] = monotonic()
+        return True
+
+    def unregister(self, sock):
+        '''
+            Remove client 'sock', returns its name or None if it was not
+            registered.
+        '''
+        name = self.sock2name.pop(sock, None)
+        if name is None:
+            return None
+        del self.name2sock[name]
+        for socks in self.states.itervalues():
+            socks.discard(sock)
+        del self.idle[sock]
+        return name
+
+    def lookup(self, name):
+        return self.name2sock.get(name)
+
+    def nameOf(self, sock):
+        return self.sock2name.get(sock)
+
+    def setState(self, sock, state, flag = True):
+        '''
+            Add 'sock' to or remove it from the clients in 'state'.
+        '''
+        if sock not in self.sock2name:
+            return False
+        if flag:
+            self.states[state].add(sock)
+        else:
+            self.states[state].discard(sock)
+        return True
+
+    def inState(self, state):
+        '''
+            Returns the set of clients in 'state', do not modify it.
+        '''
+        return self.states[state]
+
+    def touch(self, sock):
+        '''
+            Record activity of client 'sock'.
+        '''
+        if sock in self.idle:
+            del self.idle[sock]
+            self.idle[sock] = monotonic()
+
+    def idleTime(self, sock):
+        '''
+            Returns the seconds since the last activity of client 'sock'.
+        '''
+        return monotonic() - self.idle[sock]
+
+    def longestIdle(self):
+        '''
+            Returns the least recently active client and its idle time, or
+            (None, 0.0) without clients.
+        '''
+        for sock, last in self.idle.iteritems():
+            return sock, monotonic() - last
+        return None, 0.0
+
+    def __len__(self):
+        return len(self.sock2name)
+
+class MDServerMixin(object):
+    '''
+        The client bookkeeping of the server, which MDSocket and
+        MDServerListener rely on. It is combined with a multiplexer: with
+        SocketMultiplexer in MDServer, or with libmd.aio's
+        AsyncioMultiplexer to serve clients on an asyncio loop.
+    '''
+
+    def initServer(self, keepalive = False):
+        '''
+            With 'keepalive' dead clients are detected by TCP keepalive, and
+            only clients that ping the server themselves are pinged.
+        '''
+        self.keepalive = keepalive
+        self.sessions = SessionRegistry()
+        self.listeners = []
+
+        # Round trip times of all clients
+        self.rtt = Histogram(window = 65536)
+
+    def broadcastMessage(self, _type, message,
+            slow = SocketMultiplexer.SLOW_SKIP):
+        '''
+            Send a message to all registered clients. The message is encoded
+            once and the same buffer is queued for every client, see
+            SocketMultiplexer.broadcast for the 'slow' consumer policy.
+        '''
+        return self.broadcast(mdPackMessage(_type, message),
+            self.sessions.inState(SessionRegistry.REGISTERED), slow)
+
+    def regClient(self, name, passwd, source_socket):
+        '''
+            Register a client, returns False if the name is in use.
+        '''
+        print 'registerClient', name
+
+        if not self.sessions.register(name, source_socket):
+            return False
+        if not self.keepalive or source_socket.ping_optin:
+            source_socket.startPings()
+        return True
+
+    def delClient(self, sock):
+        name = self.sessions.unregister(sock)
+        print 'delClient', name
+
+        if name is None:
+            print 'ERR: delClient called but client not registered'
+
+    def reapPending(self):
+        '''
+            Drop connections that passed the registration deadline, only
+            these are visited.
+        '''
+        for sock in self.sessions.expiredPending(REGISTER_TIMEOUT):
+            sock.drop('Registration timeout', True)
+        return True
 
+    def pingTimeout(self, rtt):
+        '''
+            Returns the time to wait for a pong, given the round trip times
+            'rtt' of the client.
+        '''
+        if rtt.count < PING_RTT_SAMPLES:
+            rtt = self.rtt
+            if rtt.count < PING_RTT_SAMPLES:
+                return PING_TIMEOUT
+        return min(max(PING_RTT_FACTOR * rtt.percentile(99),
+            PING_TIMEOUT_MIN), PING_TIMEOUT)
+
+    def logPings(self):
+        '''
+            Log the round trip times of all clients.
+        '''
+        sessions = self.sessions
+        log.log([], LVL_PINGPONG, log.INFO,
+            'Ping RTT: %s, %i of %i clients awaiting pong, ' \
+            'longest idle %.1fs' % (self.rtt.summary(),
+            len(sessions.inState(SessionRegistry.AWAITING_PONG)),
+            len(sessions), sessions.longestIdle()[1]))
+        return True
+
+class MDServer(MDServerMixin, SocketMultiplexer):
+
+    def __init__(self, keepalive = False):
+        '''
+            See MDServerMixin.initServer for 'keepalive'.
+        '''
+        print 'MDServer init'    
+        # Every client has its own ping timers, a timing wheel keeps these
+        # cheap
+        SocketMultiplexer.__init__(self, MDSocket, eq = TimingWheelQueue())
+        self.initServer(keepalive)
+
+    def run(self, port, reuse_port = False, unix = None):
+        """
+            Start serving clients on 'port'. With 'reuse_port' the listener
+            shares the port with other processes through SO_REUSEPORT.
+            With 'unix' local clients are served on the unix domain socket
+            at that path as well.
         """
-        if not self.listen('', port, sock = MDServerListener):
+        # Keep log rotation from stalling the multiplexer
+        log.set_executor(self.runInThread)
+
+        if not self.listen('', port, reuse_port = reuse_port,
+                sock = MDServerListener):
             log.log([], LVL_ALWAYS, log.ERROR,
                 'Couldn\'t start listening for clients')
             exit(1)
 
+        if unix is not None and not self.listen(unix, None,
+                sock = MDServerListener):
+            log.log([], LVL_ALWAYS, log.ERROR,
+                'Couldn\'t start listening on ' + unix)
+            exit(1)
+
         # Initiate control server job
 #        self.connect(controlIP, controlPort, sock = ControlServerJob)
 
-#        # Initiate ping system
-        self.ping_event = PeriodicCall(PING_RUN_PERIOD, self.doPings)
-        self.eq.scheduleEvent(self.ping_event)
+#        # Report ping statistics, clients are pinged on their own schedule
+        self.eq.scheduleEvent(PeriodicCall(PING_RUN_PERIOD, self.logPings))
+
+        # Drop connections that do not register in time
+        self.eq.scheduleEvent(PeriodicCall(REAP_PERIOD, self.reapPending))
 
 #        self.clientPort = port
 
 
+        for signum, name in ((signal.SIGINT, 'SIGINT'),
+                (signal.SIGTERM, 'SIGTERM'), (signal.SIGHUP, 'SIGHUP')):
+            self.addSignalHandler(signum,
+                lambda signum, name = name: self.kill('Received ' + name))
+
         log.log([], LVL_ALWAYS, log.INFO,
             'Server up and running at %s:%i' %
-            (self.listener.socketIP(), port))
+            (self.listeners[0].socketIP(), port))
+        if unix is not None:
+            log.log([], LVL_ALWAYS, log.INFO,
+                'Serving local clients at ' + unix)
 
         try:
             self.startMultiplex()
@@ -64,64 +338,188 @@ class MDServer(SocketMultiplexer):
         '''
         log.log([], LVL_ALWAYS, log.ERROR, 'Stopping: ' + reason)
 
+        # Let the clients know, before the process goes away
+        self.broadcastMessage(MD_QUIT, reason[:MD_MAX_MESSAGE])
+        self.flush()
+
        # Stop listening for clients
-        if self.listener is not None:
-            self.listener.close()
-            self.listener = None
+        for listener in self.listeners:
+            listener.close()
+        self.listeners = []
 
         # Full stop.
         sys.exit(0)
         return True
 
-    def regClient(self, name, passwd, source_socket):
-        print 'registerClient', name
+class MDSupervisor(object):
+    '''
+        Prefork supervisor.
 
-        self.client2sock[name] = source_socket
+        Runs a number of worker processes that each run their own MDServer
+        on a SO_REUSEPORT listener, so the kernel spreads clients over the
+        workers. Workers that die are restarted. Clients are only known
+        to the worker that accepted them.
+    '''
 
-    def delClient(self, name):
-        print 'delClient', name
+    # Minimum time between two starts of the same worker
+    RESTART_DELAY = 1.0
 
-        if name in self.client2sock:
-            del self.client2sock[name]
-        else:
-            print 'ERR: delClient called but client not in client2sock'
-        # ELSE: Error
+    def __init__(self, workers, keepalive = False):
+        self.workers = workers
+        self.keepalive = keepalive
+        self.pids = {}
+        self.started = {}
+
+        # Workers to be started, by the time they are due. Times are taken
+        # from the monotonic clock.
+        self.restarts = {}
+        self.waker = None
+        self._keep_running = False
+
+    def run(self, port):
+        self._keep_running = True
 
-    def doPings(self):
+        # Signals wake up the select() below through the waker, so a worker
+        # that dies or a request to stop is handled right away.
+        self.waker = waker = Waker()
+        signal.set_wakeup_fd(waker._wfd)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        for i in range(self.workers):
+            self.restarts[i] = monotonic()
+
+        log.log([], LVL_ALWAYS, log.INFO,
+            'Supervising %i workers on port %i' % (self.workers, port))
+
+        while self._keep_running:
+            now = monotonic()
+            for i, due in self.restarts.items():
+                if due <= now:
+                    del self.restarts[i]
+                    self.spawn(i, port)
+
+            self.reap()
+            if not self._keep_running:
+                break
+
+            timeout = None
+            if self.restarts:
+                timeout = max(0, min(self.restarts.itervalues()) -
+                    monotonic())
+            try:
+                select([waker], [], [], timeout)
+            except select_error, e:
+                if e.args[0] != errno.EINTR:
+                    raise e
+            waker.handleRead()
+
+        # Take the workers down with us
+        for pid in self.pids:
+            os.kill(pid, signal.SIGTERM)
+        while self.pids:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            self.pids.pop(pid, None)
+
+        log.log([], LVL_ALWAYS, log.ERROR, 'Supervisor stopped')
+
+    def reap(self):
         '''
-            Executes periodic pings.
+            Collect the workers that died and schedule their restart.
         '''
-        print 'doPings'
-        # Ping all inactive clients.
-        cc = dict(self.client2sock)
-        for k, c in cc.iteritems():
-            if not c.pollRecvActivity():
-                c.doPing()
+        while self.pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    return
+                raise e
+            if not pid:
+                return
+
+            i = self.pids.pop(pid, None)
+            if i is None or not self._keep_running:
+                continue
 
-        # Since we're running in a non-blocking environment
-        # the latency received by serially calling the ping
-        # methods should be trivial in the ping check delay
-        # scheduled afterwards.
-        self.eq.scheduleEvent(DeferredCall(PING_TIMEOUT, self.checkPings))
+            log.log([], LVL_ALWAYS, log.ERROR,
+                'Worker %i (pid %i) died with status %i, restarting' %
+                (i, pid, status))
 
-        return True
+            # Do not turn a worker that dies on startup into a fork storm
+            self.restarts[i] = self.started[i] + self.RESTART_DELAY
 
-    def checkPings(self):
+    def spawn(self, i, port):
         '''
-            Drop any irresponsive clients.
+            Fork worker 'i'.
         '''
-        print 'checkPings'
-        # Check all clients
-        cc = dict(self.client2sock)
-        for k, c in cc.iteritems():
-            c.checkPing()
+        self.started[i] = monotonic()
+        pid = os.fork()
+        if pid:
+            self.pids[pid] = i
+            return pid
+
+        # Worker process, it never returns from here
+        signal.set_wakeup_fd(-1)
+        if self.waker is not None:
+            os.close(self.waker._rfd)
+            os.close(self.waker._wfd)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        code = 1
+        try:
+            try:
+                MDServer(self.keepalive).run(port, reuse_port = True)
+                code = 0
+            except SystemExit, e:
+                code = e.code if isinstance(e.code, int) else \
+                    (0 if e.code is None else 1)
+            except:
+                traceback.print_exc()
+        finally:
+            os._exit(code)
+
+    def stop(self, signum, frame):
+        self._keep_running = False
 
 class MDServerListener(ManagedMDSocket):
     def __init__(self, *args):
         ManagedMDSocket.__init__(self, *args)
-        self.muxer.listener = self
+        self.muxer.listeners.append(self)
+
+    def onAccept(self, sock):
+        # Make room for the new connection if too many did not register yet
+        evicted = self.muxer.sessions.addPending(sock, MAX_PENDING)
+        if evicted is not None:
+            evicted.drop('Too many unregistered connections', True)
+
+    def onAcceptOverload(self):
+        log.log([], LVL_ALWAYS, log.ERROR,
+            'Out of file descriptors, turning clients away')
 
 class MDSocket(ManagedMDSocket):
+
+    # Replies and pings go out together once per loop iteration
+    SEND_COALESCE = True
+    SEND_NODELAY = True
+
+    # Drop clients that stop reading instead of queueing for them forever
+    SEND_HIGH_WATER = 1 << 20
+    SEND_LOW_WATER = 1 << 18
+    SEND_STALL_TIMEOUT = 30.0
+
+    # Keep a single busy client from starving the others
+    READ_BUDGET = 65536
+    FRAME_BUDGET = 256
+
     def __init__(self, muxer, ip, port):
         print 'MDSocket init'
         ManagedMDSocket.__init__(self, muxer, ip, port)
@@ -131,7 +529,19 @@ class MDSocket(ManagedMDSocket):
             MD_PONG                 : self.pong
         })
 
-        self.pong_received = True
+        # Ping state: the pending ping event, the pong timeout event, and
+        # the id and send time of the outstanding ping
+        self.ping_event = self.pong_event = None
+        self.ping_id, self.ping_sent = 0, None
+        self.rtt = Histogram(window = 64)
+
+        # Clients that ping us are pinged in return, also in keepalive mode
+        self.ping_optin = False
+        if muxer.keepalive:
+            self.setKeepAlive(*KEEPALIVE)
+
+        # Closing may report the lost connection and drop us again
+        self.dropped = False
 
     def __del__(self):
         print 'MDSocket Del'
@@ -143,31 +553,89 @@ class MDSocket(ManagedMDSocket):
     def onRegClient(self, name, passwd):
         print 'regClient'
 
+        if hasattr(self, 'client_name'):
+            return self.sendRegisterFail('Already registered')
+        if not self.muxer.regClient(name, passwd, self):
+            return self.sendRegisterFail('Name in use')
+
         self.client_name, self.client_pass = name, passwd
-        self.muxer.regClient(name, passwd, self)
         self.sendRegisterOk()
 
+    def onRecv(self, data):
+        ManagedMDSocket.onRecv(self, data)
+        self.muxer.sessions.touch(self)
+
+    def startPings(self):
+        '''
+            Start pinging this client. The first ping is at a random point in
+            the ping period, so the pings of all clients are spread out.
+        '''
+        if self.ping_event is not None or self.pong_event is not None:
+            return False
+        self.ping_event = DeferredCall(uniform(0, PING_RUN_PERIOD),
+            self.doPing)
+        self.muxer.eq.scheduleEvent(self.ping_event)
+        return True
+
+    def stopPings(self):
+        for event in (self.ping_event, self.pong_event):
+            if event is not None:
+                self.muxer.eq.cancelEvent(event)
+        self.ping_event = self.pong_event = None
+        self.ping_sent = None
+
     def doPing(self):
+        self.ping_event = None
+
+        # A client that was active recently is alive, ping it once it has
+        # been idle for a whole period
+        idle = self.muxer.sessions.idleTime(self)
+        if idle < PING_RUN_PERIOD:
+            self.ping_event = DeferredCall(PING_RUN_PERIOD - idle +
+                uniform(0, PING_JITTER), self.doPing)
+            self.muxer.eq.scheduleEvent(self.ping_event)
+            return
+
         print 'doPing'
-        self.pong_received = False
-        self.sendPing('hai')
+        self.ping_id += 1
+        self.ping_sent = monotonic()
+        self.muxer.sessions.setState(self, SessionRegistry.AWAITING_PONG)
+        self.sendPing(str(self.ping_id))
+        self.pong_event = DeferredCall(self.muxer.pingTimeout(self.rtt),
+            self.checkPing)
+        self.muxer.eq.scheduleEvent(self.pong_event)
 
     def checkPing(self):
-        if not self.pong_received:
-            print 'no pong!'
-
-            return self.manualViolation()
+        self.pong_event = None
+        print 'no pong!'
+        return self.manualViolation()
 
-        return True
+    def onPing(self, string):
+        if not self.ping_optin:
+            self.ping_optin = True
+            if hasattr(self, 'client_name'):
+                self.startPings()
+        self.sendPong(string)
 
     def pong(self, _id):
         print 'Pong'
-        # Possibly check pong message for _id? Must match our ping request, etc
-        if self.pong_received:
-            print 'Already received pong'
+        # The pong must answer our outstanding ping
+        if self.ping_sent is None or _id != str(self.ping_id):
+            print 'Unexpected pong'
             return self.manualViolation()
 
-        self.pong_received = True
+        rtt = monotonic() - self.ping_sent
+        self.rtt.add(rtt)
+        self.muxer.rtt.add(rtt)
+        self.ping_sent = None
+        self.muxer.sessions.setState(self, SessionRegistry.AWAITING_PONG,
+            False)
+
+        self.muxer.eq.cancelEvent(self.pong_event)
+        self.pong_event = None
+        self.ping_event = DeferredCall(PING_RUN_PERIOD +
+            uniform(0, PING_JITTER), self.doPing)
+        self.muxer.eq.scheduleEvent(self.ping_event)
 
     def onProtocolViolation(self, reason):
         '''
@@ -178,13 +646,25 @@ class MDSocket(ManagedMDSocket):
 
 
     def drop(self, reason, conn_alive):
+        if self.dropped:
+            return
+        self.dropped = True
         print 'Dropping'
+        self.stopPings()
         if hasattr(self, 'client_name'):
             print 'Dropping client:', self.client_name
-            self.muxer.delClient(self.client_name)
+            self.muxer.delClient(self)
+        else:
+            self.muxer.sessions.discardPending(self)
 
         self.close()
 
+    def onSendStall(self):
+        self.drop('Send queue stalled', True)
+
+    def onQuit(self, reason):
+        self.drop('Quit: ' + reason, True)
+
     def onDisconnect(self):
         self.drop('onDisconnect', False)
 
@@ -202,8 +682,21 @@ if __name__ == '__main__':
     parse.add_option('-q','--quiet-level',dest='quiet',
             help='Verbosity level. 0 is minimum and 10000 is max.',
             default=10000, type=int)
+    parse.add_option('-w', '--workers', dest='workers',
+            help='Amount of worker processes sharing the port through ' +
+            'SO_REUSEPORT. Default is 0, a single process without ' +
+            'supervisor.', default=0, type=int)
+    parse.add_option('-k', '--keepalive', dest='keepalive',
+            help='Detect dead clients through TCP keepalive, and only ' +
+            'ping clients that ping the server.', default=False,
+            action='store_true')
+    parse.add_option('-u', '--unix', dest='unix',
+            help='Path of a unix domain socket to serve local clients on ' +
+            'as well.', default=None, type=str)
 
     opt = parse.parse_args()[0]
+    if opt.unix is not None and opt.workers > 0:
+        parse.error('--unix can not be combined with --workers')
 
     from libmd import PyLogger
     log = PyLogger()
@@ -220,6 +713,9 @@ if __name__ == '__main__':
 
     from socket import gethostbyname, error as se
 
-    server = MDServer()
-    server.run(2001)
+    if opt.workers > 0:
+        MDSupervisor(opt.workers, opt.keepalive).run(2001)
+    else:
+        server = MDServer(opt.keepalive)
+        server.run(2001, unix = opt.unix)
 
@@ -0,0 +1,137 @@
+# test_aio.py - Tests of the asyncio transport bridge
+"""
+    Tests of the asyncio transport bridge
+
+    On Python 2 these need trollius, see tests/requirements.txt. Run from
+    the top directory as: python -m unittest discover tests
+"""
+
+import socket
+import unittest
+
+import server
+from libmd import PyLogger
+from libmd.mulsoc import ManagedSocket
+from libmd.md import ManagedMDSocket, mdPackMessage, MD_PING
+from libmd.aio import AsyncioMultiplexer
+
+def freePort():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+class EchoSocket(ManagedMDSocket):
+    def onPing(self, string):
+        self.sendPong(string)
+
+class PingSocket(ManagedMDSocket):
+    def onConnect(self):
+        self.sendPing('hai')
+
+    def onPong(self, string):
+        # Answered, now ping back through a broadcast to accepted clients
+        self.muxer.received.append('pong ' + string)
+        self.muxer.broadcast(mdPackMessage(MD_PING, 'bye'),
+            self.muxer.accepted)
+
+    def onPing(self, string):
+        self.muxer.received.append('ping ' + string)
+        self.muxer.stopMultiplex()
+
+class Listener(ManagedSocket):
+    def onAccept(self, sock):
+        self.muxer.accepted.append(sock)
+
+class AsyncioBridgeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.muxer = AsyncioMultiplexer(EchoSocket)
+        self.muxer.received, self.muxer.accepted = [], []
+
+    def tearDown(self):
+        for s in self.muxer._servers:
+            s.close()
+
+    def testPingBroadcast(self):
+        muxer = self.muxer
+        port = freePort()
+        self.assertTrue(muxer.listen('127.0.0.1', port, sock = Listener))
+        self.assertTrue(muxer.connect('127.0.0.1', port, sock = PingSocket))
+
+        muxer.setAlarm(5.0)
+        muxer.onAlarm = muxer.stopMultiplex
+        muxer.startMultiplex()
+
+        self.assertEqual(len(muxer.accepted), 1)
+        self.assertEqual(muxer.received, ['pong hai', 'ping bye'])
+
+class AsyncioMDServer(server.MDServerMixin, AsyncioMultiplexer):
+    '''
+        The MD server on an asyncio loop, serving the unmodified MDSocket.
+    '''
+
+    def __init__(self):
+        AsyncioMultiplexer.__init__(self, server.MDSocket)
+        self.initServer()
+
+class ClientSocket(ManagedMDSocket):
+    def __init__(self, muxer, ip, port, name):
+        ManagedMDSocket.__init__(self, muxer, ip, port)
+        self.name = name
+
+    def onConnect(self):
+        self.sendRegister(self.name, 'secret')
+
+    def onRegisterOk(self, string):
+        self.muxer.events.append((self.name, 'registered'))
+        self.sendPing('hai')
+
+    def onRegisterFail(self, reason):
+        self.muxer.events.append((self.name, reason))
+        self.close()
+
+    def onPong(self, string):
+        self.muxer.events.append((self.name, 'pong ' + string))
+        if self.name == 'alice':
+            self.muxer.broadcastMessage(MD_PING, 'all')
+
+    def onPing(self, string):
+        self.muxer.events.append((self.name, 'ping ' + string))
+        self.sendQuit('done')
+
+class AsyncioMDServerTest(unittest.TestCase):
+
+    def setUp(self):
+        server.log = PyLogger()
+        self.muxer = AsyncioMDServer()
+        self.muxer.events = []
+
+    def tearDown(self):
+        for s in self.muxer._servers:
+            s.close()
+
+    def testSessions(self):
+        muxer = self.muxer
+        port = freePort()
+        self.assertTrue(muxer.listen('127.0.0.1', port,
+            sock = server.MDServerListener))
+        for name in ('alice', 'alice'):
+            muxer.connect('127.0.0.1', port, sock = ClientSocket, name = name)
+
+        muxer.setAlarm(2.0)
+        muxer.onAlarm = muxer.stopMultiplex
+        muxer.startMultiplex()
+
+        events = muxer.events
+        self.assertEqual(events[:4], [('alice', 'registered'),
+            ('alice', 'Name in use'), ('alice', 'pong hai'),
+            ('alice', 'ping all')])
+
+        # The quit dropped the client from the session registry
+        self.assertEqual(len(muxer.sessions), 0)
+        self.assertEqual(len(muxer.sessions.pending), 0)
+
+if __name__ == '__main__':
+    unittest.main()
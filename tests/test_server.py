@@ -0,0 +1,76 @@
+# test_server.py - Regression tests of the MD server
+"""
+    Regression tests of the MD server
+
+    The server runs in the test's thread, clients in a helper thread. Run
+    from the top directory as: python -m unittest discover tests
+"""
+
+import socket
+import struct
+import threading
+import time
+import unittest
+
+import server
+from libmd import PyLogger
+from libmd.events import DeferredCall
+from libmd.md import mdPackMessage, MD_PING, MD_QUIT
+
+def freePort():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+class MDServerTest(unittest.TestCase):
+
+    def setUp(self):
+        server.log = PyLogger()
+        self.port = freePort()
+        self.server = server.MDServer()
+        self.assertTrue(self.server.listen('127.0.0.1', self.port,
+            sock = server.MDServerListener))
+
+    def tearDown(self):
+        for listener in self.server.listeners:
+            listener.close()
+
+    def serve(self, clients, seconds):
+        t = threading.Thread(target = clients)
+        t.daemon = True
+        t.start()
+        self.server.eq.scheduleEvent(DeferredCall(seconds,
+            self.server.stopMultiplex))
+        self.server.startMultiplex()
+        t.join(1.0)
+
+    def testResetAfterQuit(self):
+        # A client that sends a request and a quit and then resets the
+        # connection makes the server flush a reply to a dead peer while
+        # it closes, the server must survive that.
+        answers = []
+
+        def clients():
+            time.sleep(0.1)
+            for i in range(3):
+                c = socket.create_connection(('127.0.0.1', self.port))
+                c.sendall(mdPackMessage(MD_PING, 'x') +
+                    mdPackMessage(MD_QUIT, 'bye'))
+                c.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                    struct.pack('ii', 1, 0))
+                c.close()
+                time.sleep(0.05)
+
+            c = socket.create_connection(('127.0.0.1', self.port))
+            c.sendall(mdPackMessage(MD_PING, 'alive'))
+            answers.append(c.recv(4096))
+            c.close()
+
+        self.serve(clients, 1.0)
+        self.assertEqual(answers, [mdPackMessage(server.MD_PONG, 'alive')])
+        self.assertEqual(len(self.server.sessions), 0)
+
+if __name__ == '__main__':
+    unittest.main()